@@ -1,19 +1,19 @@
 
 import os
-import uuid
+import gc
+import sys
+import time
+import queue
+import signal
+import threading
 import subprocess
-import urllib.parse
+import multiprocessing
 import boto3
-import json
-from flask import Flask, request, jsonify, session
 import boto3.exceptions
 import botocore.exceptions
 from configparser import ConfigParser
 
 
-app = Flask(__name__)
-
-
 config = ConfigParser()
 config.read('ann_config.ini')
 region_name = config.get('AWS', 'region_name')
@@ -21,6 +21,26 @@ s3_client = boto3.client('s3', region_name=region_name)
 sqs_client = boto3.client('sqs', region_name=region_name)
 queue_url = config.get('SQS', 'queue_url')
 
+# Load AnnTools (boto3, pymysql, the pipeline and any reference snapshot)
+# once, here, so pre-forked workers start with it all in place
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'anntools'))
+import run as anntools_run
+import driver as anntools_driver
+
+# Shared SQS consumer: package_annotator.sh bundles util/consumer.py next
+# to this file; in a repository checkout it is found in util/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir, 'util'))
+from consumer import QueueConsumer
+
+# Long-lived annotation workers; 0 starts anntools/run.py per job instead
+prefork_workers = config.getint('Annotator', 'workers', fallback=0)
+# Stream job inputs from S3 into the pipeline instead of downloading them
+stream_input = config.getboolean('Annotator', 'stream_input', fallback=False)
+# Memory to keep free per running job
+job_memory_mb = config.getint('Annotator', 'job_memory_mb', fallback=1024)
+
 
 def update_job_status(job_id, status):
     try:
@@ -45,53 +65,281 @@ def update_job_status(job_id, status):
     except Exception as e:
         print(f"Error : {e}       ")
         return False
-while True:
-    response = sqs_client.receive_message(
-        QueueUrl = queue_url,
-        MaxNumberOfMessages = 1,
-        WaitTimeSeconds= 20
-    )
-    if 'Messages' in response:
-        message = response['Messages'][0]
-        body = message['Body']
-        receipt_handle = message['ReceiptHandle']
+
+def annotation_worker(job_queue, status_queue):
+    """Run jobs from job_queue in this (forked) process until it gets None
+
+    The job is marked RUNNING as the worker picks it up, and the parent
+    hears about both the start and the finish over status_queue.
+    """
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, local_file_path, email_id, s3_input = job
+        status_queue.put(('started', job_id, os.getpid()))
+        update_job_status(job_id, "RUNNING")
         try:
-            data = json.loads(body)
-            message=data.get('Message')
-            message_data = json.loads(message)
-            job_id = message_data.get('job_id')
-            user_id = message_data.get('user_id')
-            email_id = message_data.get('email_id')
-            input_file_name = message_data.get('input_file_name')
-            if not input_file_name:
-                raise ValueError("Input file is missing")
-            s3_inputs_bucket = message_data.get('s3_inputs_bucket')
-            s3_key_input_file = message_data.get('s3_key_input_file')
-            job_id_directory = f'job_ids/{user_id}'
-            if not os.path.exists(job_id_directory):
-                os.makedirs(job_id_directory)
-            job_directory = os.path.join(job_id_directory, job_id)
-            if not os.path.exists(job_directory):
-                os.makedirs(job_directory)
-            local_file_path = os.path.join(job_directory, input_file_name)
-            s3_client.download_file(s3_inputs_bucket, s3_key_input_file, local_file_path)
+            anntools_run.run_job(local_file_path, email_id, s3_input)
+        except Exception as e:
+            print(f"Annotation of job {job_id} failed: {str(e)}")
+        status_queue.put(('finished', job_id, os.getpid()))
+
+
+def start_worker(context, job_queue, status_queue):
+    # Not daemonic: a worker annotating with [AnnTools] workers other than
+    # 1 starts a process pool of its own, which daemons may not do. The
+    # scheduler stops its workers itself instead (JobScheduler.stop).
+    worker = context.Process(target=annotation_worker,
+        args=(job_queue, status_queue))
+    worker.start()
+    return worker
+
+
+def start_workers(count):
+    """Fork count annotation workers that take jobs from a shared queue
+
+    Everything loaded so far is moved out of the collector's reach with
+    gc.freeze() first, so collections in the workers do not touch (and
+    copy) the pages they share with this process. This runs before any
+    threads start, so forking is safe here; workers started later, to
+    replace ones that died, come from a fork server instead (the context
+    returned), which has this module loaded but never runs threads.
+    """
+    anntools_driver.preload()
+    gc.collect()
+    gc.freeze()
+    spare = multiprocessing.get_context('forkserver')
+    spare.set_forkserver_preload(['__main__'])
+    # Queues from the fork server's context, so replacements can share them
+    job_queue = spare.Queue()
+    status_queue = spare.Queue()
+    context = multiprocessing.get_context('fork')
+    workers = [start_worker(context, job_queue, status_queue)
+        for i in range(count)]
+    return spare, job_queue, status_queue, workers
+
+
+def available_memory_mb():
+    """MemAvailable from /proc/meminfo, or None where there is no such file"""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        return None
+    return None
+
+
+def max_jobs_in_flight():
+    """Configured max_in_flight, or one job per core within free memory"""
+    configured = config.getint('Annotator', 'max_in_flight', fallback=0)
+    if configured > 0:
+        return configured
+    limit = os.cpu_count() or 1
+    free_mb = available_memory_mb()
+    if free_mb is not None:
+        limit = min(limit, max(1, free_mb // job_memory_mb))
+    return limit
+
+
+class JobScheduler(object):
+    """Bounded scheduler for annotation jobs
+
+    Tracks the jobs in flight, either as run.py child processes or as jobs
+    handed to pre-forked workers, and reaps them as they finish. The main
+    loop only pulls from SQS while has_capacity() is true: fewer than
+    max_in_flight jobs are running and the instance still has memory for
+    another one. Messages left in the queue stay there for other
+    annotator instances.
+    """
+    def __init__(self, max_in_flight, prefork_workers=0):
+        self.max_in_flight = max_in_flight
+        self.prefork_workers = prefork_workers
+        self.children = {}
+        self.in_flight = {}
+        # start() runs on the consumer's handler thread, reap() on the main one
+        self.lock = threading.Lock()
+        if prefork_workers > 0:
+            # Queued jobs count as in flight, so keep no more than one per
+            # worker
+            self.max_in_flight = min(max_in_flight, prefork_workers)
+            # self.context is the fork server replacement workers come from
+            self.context, self.job_queue, self.status_queue, self.workers = \
+                start_workers(prefork_workers)
+
+    def running(self):
+        return len(self.in_flight) if self.prefork_workers > 0 \
+            else len(self.children)
+
+    def free_slots(self):
+        return max(0, self.max_in_flight - self.running())
+
+    def has_capacity(self):
+        if self.free_slots() == 0:
+            return False
+        free_mb = available_memory_mb()
+        if free_mb is not None and free_mb < job_memory_mb:
+            print(f"Only {free_mb} MB available; holding off new jobs")
+            return False
+        return True
 
+    def start(self, job_id, local_file_path, email_id, s3_input=None):
+        with self.lock:
+            self.start_locked(job_id, local_file_path, email_id, s3_input)
+
+    def start_locked(self, job_id, local_file_path, email_id, s3_input):
+        if self.prefork_workers > 0:
+            # Hand the job to a warm worker; it marks the job RUNNING
+            self.in_flight[job_id] = None
+            self.job_queue.put((job_id, local_file_path, email_id, s3_input))
+        else:
             # Execute the annotator script using subprocess
             annotate_path = "anntools/run.py"
-            subprocess.Popen(["python", annotate_path, job_id, local_file_path, email_id])
+            args = ["python", annotate_path, job_id, local_file_path, email_id]
+            if s3_input is not None:
+                args.extend(s3_input)
+            self.children[job_id] = subprocess.Popen(args)
             update_job_status(job_id, "RUNNING")
-            sqs_client.delete_message(
-                QueueUrl = queue_url,
-                ReceiptHandle = receipt_handle
-            )
-        except botocore.exceptions.ClientError as ce:
-            print(f"S3 file download error: {str(ce)}")
-        except subprocess.CalledProcessError as se:
-            print(f"Subprocess error occured: {str(se)}")
-        except ValueError as ve:
-            print(f"ValueError: {str(ve)}")
-        except Exception as e:
-            print(f"An error occurred: {str(e)}")
-    else:
-        print("No messages received. Waiting...")
 
+    def reap(self):
+        """Forget finished jobs and replace workers that died"""
+        with self.lock:
+            self.reap_locked()
+
+    def reap_locked(self):
+        for job_id, child in list(self.children.items()):
+            if child.poll() is not None:
+                if child.returncode != 0:
+                    print(f"Annotation of job {job_id} exited with " +
+                        f"{child.returncode}")
+                del self.children[job_id]
+
+        if self.prefork_workers == 0:
+            return
+        while True:
+            try:
+                event, job_id, pid = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            if event == 'started':
+                self.in_flight[job_id] = pid
+            else:
+                self.in_flight.pop(job_id, None)
+
+        for i, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                print(f"Annotation worker {worker.pid} exited; " +
+                    "starting another")
+                for job_id, pid in list(self.in_flight.items()):
+                    if pid == worker.pid:
+                        print(f"Annotation of job {job_id} was lost")
+                        del self.in_flight[job_id]
+                self.drop_orphaned_jobs()
+                self.workers[i] = start_worker(self.context, self.job_queue,
+                    self.status_queue)
+
+    def drop_orphaned_jobs(self):
+        """Forget queued jobs that a dead worker took but never started
+
+        Jobs still marked queued (pid None) are in the order they were put
+        on the FIFO job queue, so all but the newest as many as the queue
+        still holds have been taken by a worker. Live workers report
+        'started' for theirs, which marks them in flight again.
+        """
+        queued = [job_id for job_id, pid in self.in_flight.items()
+            if pid is None]
+        waiting = self.job_queue.qsize()
+        for job_id in queued[0:max(0, len(queued) - waiting)]:
+            print(f"Annotation of job {job_id} was lost")
+            del self.in_flight[job_id]
+
+    def stop(self, timeout=30):
+        """Ask the pre-forked workers to exit, and end those that do not
+
+        Workers finish the job they are on first; any still running after
+        timeout seconds are terminated.
+        """
+        if self.prefork_workers == 0:
+            return
+        for worker in self.workers:
+            self.job_queue.put(None)
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.time()))
+        for worker in self.workers:
+            if worker.is_alive():
+                print(f"Annotation worker {worker.pid} did not exit; " +
+                    "terminating it")
+                worker.terminate()
+                worker.join()
+
+
+def handle_message(message_data, message):
+    """Download a job's input and start it; True once the job is started"""
+    try:
+        job_id = message_data.get('job_id')
+        user_id = message_data.get('user_id')
+        email_id = message_data.get('email_id')
+        input_file_name = message_data.get('input_file_name')
+        if not input_file_name:
+            raise ValueError("Input file is missing")
+        s3_inputs_bucket = message_data.get('s3_inputs_bucket')
+        s3_key_input_file = message_data.get('s3_key_input_file')
+        job_id_directory = f'job_ids/{user_id}'
+        if not os.path.exists(job_id_directory):
+            os.makedirs(job_id_directory)
+        job_directory = os.path.join(job_id_directory, job_id)
+        if not os.path.exists(job_directory):
+            os.makedirs(job_directory)
+        local_file_path = os.path.join(job_directory, input_file_name)
+        if stream_input:
+            # The job reads its records straight from S3
+            scheduler.start(job_id, local_file_path, email_id,
+                (s3_inputs_bucket, s3_key_input_file))
+            return True
+        s3_client.download_file(s3_inputs_bucket, s3_key_input_file, local_file_path)
+
+        scheduler.start(job_id, local_file_path, email_id)
+        return True
+    except botocore.exceptions.ClientError as ce:
+        print(f"S3 file download error: {str(ce)}")
+    except subprocess.CalledProcessError as se:
+        print(f"Subprocess error occured: {str(se)}")
+    except ValueError as ve:
+        print(f"ValueError: {str(ve)}")
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+    return False
+
+
+def scheduler_capacity():
+    """Jobs the scheduler can take now, less those still downloading"""
+    scheduler.reap()
+    if not scheduler.has_capacity():
+        return 0
+    return scheduler.free_slots() - consumer.handling()
+
+
+def handle_sigterm(signum, frame):
+    sys.exit(0)
+
+
+# The fork server that replaces workers imports this module; only the
+# annotator itself runs the scheduler and the consumer
+if __name__ == '__main__':
+    scheduler = JobScheduler(max_jobs_in_flight(), prefork_workers)
+
+    consumer = QueueConsumer(sqs_client, queue_url, handle_message,
+        concurrency=config.getint('Annotator', 'download_concurrency',
+            fallback=2),
+        capacity=scheduler_capacity, name='job_requests')
+
+    # Stop cleanly on SIGTERM as on Ctrl-C, so the workers are not orphaned
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        consumer.run()
+    finally:
+        consumer.stop()
+        scheduler.stop()
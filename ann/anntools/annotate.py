@@ -10,8 +10,11 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from collections import Counter
+
 import file_utils as fu
 import utils as u
+from reference import Reference
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -52,6 +55,12 @@ def collapseRefSeq(line):
     return  ';'.join(collapsed)
 
 
+"""Collapses one bigRefSeq table row (id first)
+"""
+def collapseRefSeqRow(row):
+    return collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]]))
+
+
 def binarySearchUniqueAndSorted(arg0, key):
     low = 0;
     high = len(arg0) - 1
@@ -107,398 +116,315 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""VCF meta-information and column header lines are passed through as is
+"""
+def isHeaderLine(line):
+    return line.startswith('#') or line.startswith('CHROM')
 
-    inds = getFormatSpecificIndices(format=format)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+"""Lines are read in blocks of this many so that batched lookups (see
+prefetchDbSnp) can resolve a whole block with one query
+"""
+BLOCK_SIZE = 1000
 
-    for line in fh:
+"""Splits stripped lines into blocks of (fields, header line) pairs
+Exactly one of the two is set for each line.
+"""
+def readBlocks(lines, sep='\t', size=BLOCK_SIZE):
+    block = []
+    for line in lines:
         line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
-
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
-
-            linenum = linenum + 1
-
+        if isHeaderLine(line):
+            block.append((None, line))
         else:
-            fh_out.write(line + '\n')
+            block.append((line.split(sep), None))
+        if (len(block) >= size):
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+"""Runs a single per-record annotator over a VCF file
+Each stage reads the previous stage's temp file and writes its own; the
+fused engine in driver.py runs all record annotators in a single pass.
+prefetch, if given, is called with the records of each block before
+they are annotated.
+"""
+def runStage(infile, outfile, annotate, sep='\t', prefetch=None):
+    fh = open(infile)
+    fh_out = open(outfile, "w")
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    for block in readBlocks(fh, sep):
+        if prefetch is not None:
+            prefetch([fields for (fields, header) in block if header is None])
+        for (fields, header) in block:
+            if header is not None:
+                fh_out.write(header + '\n')
+            else:
+                fields = annotate(fields)
+                fh_out.write('\t'.join(fields) + '\n')
 
-    conn.close()
     fh.close()
     fh_out.close()
 
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+"""Per-record annotators
+Each takes the split fields of one VCF data record, the Reference for
+the run and a Counter for the stage's statistics, and returns
+the annotated fields.
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+def dbSnpChrom(fields, inds):
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+    return chr
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
+"""Batched dbSNP lookup for a block of records
+Fetches every dbSNP row at the block's positions with one query per
+chromosome; annotateDbSnp then filters them client-side.
+"""
+def prefetchDbSnp(records, refdb, inds):
+    refdb.prefetchDbSnp([(dbSnpChrom(fields, inds), fields[inds[1]].strip())
+        for fields in records])
+
+
+def annotateDbSnp(fields, refdb, counts, inds, varclass='SNV'):
+    chr = dbSnpChrom(fields, inds)
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    alt = clean_mysql_chars(fields[inds[3]]).strip()
+
+    compRef = getComplementary(ref)
+    compAlt = getComplementary(alt)
+
+    rows = refdb.dbSnp(chr, pos, ref, compRef, varclass)
+
+    fields[2] = '.'
+    rsids = []
+    mafs = []
+    if (len(rows) > 0):
+        for row in rows:
+            rsids.append(str(row[3]))
+            if (str(row[7]) != '.'):
+                mafs.append('GMAF=' + str(row[7]))
+
+        maf_str=''
+        if (len(mafs) > 0):
+            maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+        counts['in_dbsnp'] += 1
+        if (str(fields[7]) == '.'):
+            fields[7] = 'DB' + maf_str
+        else:
+            fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+        fields[2] = str(';'.join(rsids))
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+    ## otherwise rsid stays reset to "." - in case there was annotation
+    ## from old release of dbSNP
+    counts['records'] += 1
+    return fields
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+def writeDbSnpLog(fh_log, counts, **kwargs):
+    linenum = counts['records'] + 1
+    ratioInDbSnp = (counts['in_dbsnp'] / float(linenum)) * 100
+    fh_log.write("## Please notice that all Isoforms were counted\n")
+    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+    fh_log.write(f"Total: {str(linenum)}\n")
+    fh_log.write(f"In dbSNP: {str(counts['in_dbsnp'])} ({str(ratioInDbSnp)}%)\n")
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    counts = Counter()
+    inds = getFormatSpecificIndices(format=format)
+    refdb = Reference(u.db_connect())
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+    runStage(vcf + tmpextin, vcf + tmpextout,
+        lambda fields: annotateDbSnp(fields, refdb, counts, inds,
+            varclass=varclass), sep=sep,
+        prefetch=lambda records: prefetchDbSnp(records, refdb, inds))
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    fh_log = open(vcf + '.count.log', 'w')
+    writeDbSnpLog(fh_log, counts)
+    fh_log.close()
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    refdb.close()
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+def annotateBigRefGene(fields, refdb, counts, inds):
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            vcf_linenum = vcf_linenum + 1
+    compRef = getComplementary(ref)
+    compAlt = getComplementary(alt)
 
-        else:
-            fh_out.write(line + '\n')
+    collapsed = refdb.bigRefGene(chr, pos, ref, alt, compRef, compAlt,
+        collapseRefSeqRow)
+    if (len(collapsed) > 0):
+        m = set(collapsed)
+        fields[7] = fields[7] + ';' + ';'.join(m)
+        if (str(fields[7]).startswith(".;")):
+            fields[7] = str(fields[7]).replace('.;', '', 1)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return fields
 
 
-"""Get information about location in gene structures
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    counts = Counter()
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
+    refdb = Reference(u.db_connect())
+
+    runStage(vcf + tmpextin, vcf + tmpextout,
+        lambda fields: annotateBigRefGene(fields, refdb, counts, inds),
+        sep=sep)
+
+    refdb.close()
+
+
+def annotateGenes(fields, refdb, counts, inds, table='refGene',
+    promoter_offset=500):
+
+    chr = fields[inds[0]].strip()
+
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+
+    pos = fields[inds[1]].strip()
+    info_field = clean_mysql_chars(fields[7]).strip()
+
+    transcripts = refdb.transcripts(table, chr, pos, promoter_offset)
+    info = []
+
+    if (len(transcripts) > 0):
+        cnt = 1
+        for tx in transcripts:
+            row = tx.row
+            #count location
+            positionType = str(u.parse_field(info_field,
+                'positionType', ';', '='))
+
+            if (positionType == 'intron'):
+                counts['intronic'] += 1
+            elif (positionType == 'non_coding_intron'):
+                counts['non_coding_intronic'] += 1
+            elif (positionType == 'CDS'):
+                counts['cds'] += 1
+            elif (positionType == 'non_coding_exon'):
+                counts['non_coding_exonic'] += 1
+            elif (positionType == 'utr5'):
+                counts['utr5'] += 1
+            elif (positionType == 'utr3'):
+                counts['utr3'] += 1
+
+            region = ""
+            pos = int(pos)
+
+            if tx.isNonCoding():
+                exons = ["non_coding_exon=" + "ex" + str(tx.exonNumber(e)) +
+                    '/' + str(tx.exonCount) for e in tx.exons(pos)]
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+            elif tx.inCds(pos):
+                exons = ["exon=" + "ex" + str(tx.exonNumber(e)) + '/' +
+                    str(tx.exonCount) for e in tx.exons(pos)]
+                counts['exonic'] += len(exons)
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+
+            elif tx.inPromoter(pos):
+                cpg = tx.cpgIsland(pos)
+                if (cpg is not None):
+                    region = 'putativePromoterRegion=' + \
+                        "".join(str(cpg[3]).split())
+                    counts['promoter'] += 1
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+            else:
+                region = ''
 
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+            if (region != ''):
+                info.append(collapseGeneNames(row=row,
+                    indices=indicesKnownGenes, region=region, cnt=cnt))
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
+            cnt = cnt + 1
 
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+        str_info = ";".join(info)
+        fields[7] = fields[7] + ';' + str_info
 
-                    else:
-                        region = ''
+    else:
+        fields[7] = fields[7] + ";positionType=interGenic"
+        counts['interGenic'] += 1
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+    return fields
 
-                    cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+def writeGenesLog(fh_log, counts, **kwargs):
+    print("Variants located:")
+    fh_log.write("Variants located:\n")
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+    print(f"In interGenic {str(counts['interGenic'])}")
+    fh_log.write(f"In interGenic {str(counts['interGenic'])}\n")
 
-            linenum = linenum + 1
+    print(f"In CDS {str(counts['cds'])}")
+    fh_log.write(f"In CDS {str(counts['cds'])}\n")
 
-        else:
-            fh_out.write(line + '\n')
+    print(f"In \'3 UTR {str(counts['utr3'])}")
+    fh_log.write(f"In \'3 UTR {str(counts['utr3'])}\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    print(f"In \'5 UTR {str(counts['utr5'])}")
+    fh_log.write(f"In \'5 UTR {str(counts['utr5'])}\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    print(f"In Intronic {str(counts['intronic'])}")
+    fh_log.write(f"In Intronic {str(counts['intronic'])}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    print(f"In Non_coding_intronic {str(counts['non_coding_intronic'])}")
+    fh_log.write(f"In Non_coding_intronic {str(counts['non_coding_intronic'])}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    print(f"In Exonic {str(counts['exonic'])}")
+    fh_log.write(f"In Exonic {str(counts['exonic'])}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    print(f"In Non_coding_exonic {str(counts['non_coding_exonic'])}")
+    fh_log.write(f"In Non_coding_exonic {str(counts['non_coding_exonic'])}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    print(f"In Putative Promoter Region {str(counts['promoter'])}")
+    fh_log.write(f"In Putative Promoter Region {str(counts['promoter'])}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+"""Get information about location in gene structures
+"""
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    counts = Counter()
+    inds = getFormatSpecificIndices(format=format)
+    refdb = Reference(u.db_connect())
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    runStage(vcf + tmpextin, vcf + tmpextout,
+        lambda fields: annotateGenes(fields, refdb, counts, inds,
+            table=table, promoter_offset=promoter_offset), sep=sep)
 
-    fh_out.close()
+    fh_log = open(vcf + '.count.log', 'a')
+    writeGenesLog(fh_log, counts)
     fh_log.close()
-    fh.close()
-    conn.close()
+
+    refdb.close()
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -712,400 +638,220 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     conn.close()
 
 
-"""Overlap with tfbsConsSites
+"""Log line shared by the overlap stages
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+def writeOverlapLog(fh_log, counts, table=None, **kwargs):
+    fh_log.write(f"In {str(table)}: {str(counts['var_count'])} in " + \
+        f"{str(counts['line_count'])} variants\n")
 
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+"""Runs an overlap stage and appends its counts to the log
+"""
+def runOverlapStage(vcf, annotate, table, tmpextin, tmpextout, format='vcf',
+    sep='\t', writeLog=writeOverlapLog):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    counts = Counter()
+    inds = getFormatSpecificIndices(format=format)
+    refdb = Reference(u.db_connect())
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    runStage(vcf + tmpextin, vcf + tmpextout,
+        lambda fields: annotate(fields, refdb, counts, inds, table=table),
+        sep=sep)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    fh_log = open(vcf + '.count.log', 'a')
+    writeLog(fh_log, counts, table=table)
+    fh_log.close()
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    refdb.close()
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+def annotateTfbsConsSites(fields, refdb, counts, inds, table='tfbsConsSites'):
+    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
 
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
+    chr = fields[inds[0]].strip()
+    # For some reason this table has no "chr" preceeding number
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    pos=fields[inds[1]].strip()
+    chrIndex=chr.replace('chr', '')
 
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
+    if (chrIndex in allowed_chrom):
+        rows = refdb.tfbsSites('tfbsConsSites' + chrIndex, pos)
+        records = []
 
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+        if (len(rows) > 0):
+            counts['line_count'] += 1
 
-                    fh_out.write('\t'.join(fields) + '\n')
+            for row in rows:
+                counts['var_count'] += 1
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+            if str(fields[7]).endswith(';'):
+                fields[7] = fields[7] + ';'.join(records)
+            else:
+                fields[7] = fields[7] + ';' + ';'.join(records)
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+    return fields
 
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+"""Overlap with tfbsConsSites
+"""
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runOverlapStage(vcf, annotateTfbsConsSites, table, tmpextin, tmpextout,
+        format=format, sep=sep)
+
+
+def annotateGadAll(fields, refdb, counts, inds, table='gadAll'):
+    chr = fields[inds[0]].strip()
+    # For some reason this table has no "chr" preceeding number
+    if chr.startswith("chr"):
+        chr = str(chr).replace("chr", "")
+
+    pos = fields[inds[1]].strip()
+
+    rows = refdb.overlapping(table, 'chromosome', chr, pos)
+    records = []
+
+    if (len(rows) > 0):
+        counts['line_count'] += 1
+        r_tmp = []
+        for row in rows:
+            counts['var_count'] += 1
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]) )
+                records.append(str(table) + '=' + str(row[3]))
+        if str(fields[7]).endswith(';'):
+            fields[7] = fields[7] + ';'.join(records)
+        else:
+            fields[7] = fields[7] + ';' + ';'.join(records)
+        # Annotated records have always been written tab-space separated
+        fields = '\t '.join(fields).split('\t')
+
+    return fields
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runOverlapStage(vcf, annotateGadAll, table, tmpextin, tmpextout,
+        format=format, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def annotateGwasCatalog(fields, refdb, counts, inds, table='gwasCatalog'):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    pos = fields[inds[1]].strip()
 
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    rows = refdb.overlapping(table, 'chrom', chr, pos, 'chromEnd', 'chromEnd')
+    records = []
 
-            linenum = linenum + 1
+    if (len(rows) > 0):
+        counts['line_count'] += 1
+        for row in rows:
+            counts['var_count'] += 1
+            records.append(str(table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
+        if str(fields[7]).endswith(';'):
+            fields[7] = fields[7] + ';'.join(records)
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            fields[7] = fields[7] + ';' + ';'.join(records)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return fields
 
 
 """ Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runOverlapStage(vcf, annotateGwasCatalog, table, tmpextin, tmpextout,
+        format=format, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def annotateHugo(fields, refdb, counts, inds, table='hugo'):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+    pos=fields[inds[1]].strip()
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    rows = refdb.overlapping(table, 'chrom', chr, pos)
+    records = []
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    if (len(rows) > 0):
+        counts['line_count'] += 1
+        r_tmp = []
+        for row in rows:
+            counts['var_count'] += 1
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        records_str = ','.join(records).replace(';', ',')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if str(fields[7]).endswith(';'):
+            fields[7] = fields[7] +records_str
+        else:
+            fields[7] = fields[7] + ';' + records_str
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return fields
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    runOverlapStage(vcf, annotateHugo, table, tmpextin, tmpextout,
+        format=format, sep=sep)
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
+def annotateGenomicSuperDups(fields, refdb, counts, inds,
+    table='genomicSuperDups'):
 
-                    records_str = ','.join(records).replace(';', ',')
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    pos = fields[inds[1]].strip()
+    isOverlap = False
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    rows = refdb.overlapping(table, 'chrom', chr, pos)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    if (len(rows) > 0):
+        rows = rows[0]
+        counts['line_count'] += 1
+        counts['var_count'] += 1
+        isOverlap = True
+        otherChrom = rows[7]
+        otherStart = rows[8]
+        otherEnd = rows[9]
+        fields[7] = fields[7] + ';' + str(table) + '=' + \
+            str(isOverlap) + ';' + 'otherChrom=' + \
+            str(otherChrom) + ';otherStart=' + \
+            str(otherStart) + ';otherEnd=' + str(otherEnd)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return fields
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runOverlapStage(vcf, annotateGenomicSuperDups, table, tmpextin,
+        tmpextout, format=format, sep=sep)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1187,21 +933,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     fh_out.close()
 
 
-"""Method to find overlap with Cytoband table
-"""
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+def annotateCytoband(fields, refdb, counts, inds, table='cytoBand'):
     colindex = 12
     startName = 'txStart'
     endName = 'txEnd'
@@ -1211,193 +943,106 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         startName = 'chromStart'
         endName = 'chromEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    pos = fields[inds[1]].strip()
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
+    overlapsWith = []
+    rows = refdb.overlapping(table, 'chrom', chr, pos, startName, endName)
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+    if (len(rows) > 0):
+        counts['line_count'] += 1
+        for row in rows:
+            counts['var_count'] += 1
+            overlapsWith.append(str(row[colindex]))
+        overlapsWith = u.dedup(overlapsWith)
+        cytoband = ';'.join([str(x) for x in overlapsWith])
 
-            linenum = linenum + 1
+        if str(fields[7]).endswith(";"):
+            fields[7] = fields[7] + str(table) + '=' + str(cytoband)
         else:
-            fh_out.write(line + '\n')
+            fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    return fields
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
-
-"""Method to find overlap with CNV tables
+"""Method to find overlap with Cytoband table
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runOverlapStage(vcf, annotateCytoband, table, tmpextin, tmpextout,
+        format=format, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def annotateCnv(fields, refdb, counts, inds, table='dgv_Cnv'):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+    pos = fields[inds[1]].strip()
+    isOverlap = False
+    rows = refdb.overlapping(table, 'chrom', chr, pos)
 
-            linenum = linenum + 1
+    if (len(rows) > 0):
+        counts['line_count'] += 1
+        counts['var_count'] += 1
+        isOverlap = True
+        if str(fields[7]).endswith(";"):
+            fields[7] = fields[7] + str(table) + '=' + \
+            str(isOverlap)
         else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            fields[7] = fields[7] + ';' + str(table) + \
+            '='+str(isOverlap)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return fields
 
 
-"""Method to find overlap with targetScanS tables
+"""Method to find overlap with CNV tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    runOverlapStage(vcf, annotateCnv, table, tmpextin, tmpextout,
+        format=format, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def annotateMiRNA(fields, refdb, counts, inds, table='targetScanS'):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    pos = fields[inds[1]].strip()
+    rows = refdb.overlapping(table, 'chrom', chr, pos)
 
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+    if (len(rows) > 0):
+        rows = rows[0]
+        counts['line_count'] += 1
+        counts['var_count'] += 1
+        t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+            str(rows[2]) + '_' + str(rows[3])
+        t = 'miRNAsites=' + t.strip()
+        if str(fields[7]).endswith(";"):
+            fields[7] = fields[7] + t
+        else:
+            fields[7] = fields[7] + ';' + t
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+    return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def writeMiRNALog(fh_log, counts, **kwargs):
+    fh_log.write(f"In miRNAsites: {str(counts['var_count'])} in " + \
+        f"{str(counts['line_count'])} variants\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
-### EOF
\ No newline at end of file
+"""Method to find overlap with targetScanS tables
+"""
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t'):
+
+    runOverlapStage(vcf, annotateMiRNA, table, tmpextin, tmpextout,
+        format=format, sep=sep, writeLog=writeMiRNALog)
+
+### EOF
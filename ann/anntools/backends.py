@@ -0,0 +1,246 @@
+# backends.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Reference database backends: MySQL (RDS) and a local SQLite file
+#
+# Build a local SQLite reference from the configured backend with:
+#   python backends.py <sqlite_file> [table ...]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import sqlite3
+
+from snapshot import SNAPSHOT_TABLES
+
+
+"""Reference backend on the annotator MySQL database
+Queries use %s placeholders; interval lookups are plain range predicates.
+A connection taken from a pool.ConnectionPool goes back to it on close().
+"""
+class MySQLBackend(object):
+    name = 'mysql'
+
+    def __init__(self, conn, pool=None):
+        self.conn = conn
+        self.pool = pool
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+
+    def query(self, sql, params=()):
+        cursor = self.conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    """Rows of a query, with the column names
+    """
+    def describedQuery(self, sql, params=()):
+        cursor = self.conn.cursor()
+        cursor.execute(self.placeholders(sql), params)
+        rows = cursor.fetchall()
+        columns = [str(d[0]) for d in cursor.description]
+        cursor.close()
+        return (columns, rows)
+
+    """All rows of one chromosome of a table, with the column names;
+    the whole table if chromCol is None
+    """
+    def chromosome(self, table, chromCol, chrom):
+        if chromCol is None:
+            return self.describedQuery('select * from ' + table)
+        return self.describedQuery('select * from ' + table + ' where ' +
+            chromCol + ' = %s', (str(chrom),))
+
+    """Rows of table overlapping the window lo..hi (startCol <= hi and
+    endCol >= lo), with the column names
+    """
+    def window(self, table, chromCol, chrom, lo, hi, startCol='chromStart',
+        endCol='chromEnd'):
+
+        sql = 'select * from ' + table + ' where '
+        params = []
+        if chromCol is not None:
+            sql = sql + chromCol + ' = %s AND '
+            params.append(str(chrom))
+        sql = sql + startCol + ' <= %s AND ' + endCol + ' >= %s'
+        params.extend([int(hi), int(lo)])
+        return self.describedQuery(sql, params)
+
+    """Rows of table with (startCol - pad) <= pos <= (endCol + pad),
+    restricted to chrom unless chromCol is None
+    """
+    def interval(self, table, chromCol, chrom, pos, startCol='chromStart',
+        endCol='chromEnd', columns=None, pad=0):
+
+        sql = 'select ' + (', '.join(columns) if columns else '*') + \
+            ' from ' + table + ' where '
+        params = []
+        if chromCol is not None:
+            sql = sql + chromCol + ' = %s AND '
+            params.append(str(chrom))
+        if pad:
+            sql = sql + '(' + startCol + ' - %s) <= %s AND %s <= (' + \
+                endCol + ' + %s)'
+            params.extend([pad, int(pos), int(pos), pad])
+        else:
+            sql = sql + startCol + ' <= %s AND %s <= ' + endCol
+            params.extend([int(pos), int(pos)])
+        return self.query(sql, params)
+
+    def placeholders(self, sql):
+        return sql
+
+
+"""Reference backend on a local SQLite file
+Interval tables carry an rtree_i32 index over (chromosome id, start, end)
+and the exact-position tables a composite (chromosome, position) index,
+so lookups never leave the box.
+"""
+class SQLiteBackend(MySQLBackend):
+    name = 'sqlite'
+
+    def __init__(self, conn):
+        MySQLBackend.__init__(self, conn)
+        tables = [row[0] for row in conn.execute(
+            "select name from sqlite_master where type = 'table'")]
+        self.rtrees = set(t[:-len('_rtree')] for t in tables
+            if t.endswith('_rtree'))
+        self.chromIds = {}
+        if 'ref_chroms' in tables:
+            self.chromIds = dict(conn.execute('select name, id from ref_chroms'))
+
+    def query(self, sql, params=()):
+        return self.conn.execute(self.placeholders(sql), params).fetchall()
+
+    def placeholders(self, sql):
+        return sql.replace('%s', '?')
+
+    def interval(self, table, chromCol, chrom, pos, startCol='chromStart',
+        endCol='chromEnd', columns=None, pad=0):
+
+        if (table not in self.rtrees) or \
+            (SNAPSHOT_TABLES[table][1:] != (startCol, endCol)):
+            return MySQLBackend.interval(self, table, chromCol, chrom, pos,
+                startCol, endCol, columns, pad)
+
+        sql = 'select ' + (', '.join('t.' + c for c in columns)
+            if columns else 't.*') + ' from ' + table + ' t join ' + \
+            table + '_rtree r on t.rowid = r.id where ' + \
+            'r.minPos <= ? AND r.maxPos >= ?'
+        params = [int(pos) + pad, int(pos) - pad]
+        if chromCol is not None:
+            chromId = self.chromIds.get(str(chrom))
+            if chromId is None:
+                return []
+            sql = sql + ' AND r.minChrom <= ? AND r.maxChrom >= ?'
+            params.extend([chromId, chromId])
+        # Keep table order, which the first-match stages rely on
+        return self.conn.execute(sql + ' order by t.rowid', params).fetchall()
+
+    def window(self, table, chromCol, chrom, lo, hi, startCol='chromStart',
+        endCol='chromEnd'):
+
+        if (table not in self.rtrees) or \
+            (SNAPSHOT_TABLES[table][1:] != (startCol, endCol)):
+            return MySQLBackend.window(self, table, chromCol, chrom, lo, hi,
+                startCol, endCol)
+
+        sql = 'select t.* from ' + table + ' t join ' + table + \
+            '_rtree r on t.rowid = r.id where r.minPos <= ? AND r.maxPos >= ?'
+        params = [int(hi), int(lo)]
+        if chromCol is not None:
+            chromId = self.chromIds.get(str(chrom))
+            if chromId is None:
+                return self.describedQuery('select * from ' + table +
+                    ' where 0')
+            sql = sql + ' AND r.minChrom <= ? AND r.maxChrom >= ?'
+            params.extend([chromId, chromId])
+        return self.describedQuery(sql + ' order by t.rowid', params)
+
+
+"""SQLite column type for a sample value
+"""
+def sqliteType(value):
+    if isinstance(value, int):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'REAL'
+    if isinstance(value, (bytes, bytearray)):
+        return 'BLOB'
+    return 'TEXT'
+
+
+"""Copy reference tables from a backend into a local SQLite file
+"""
+def exportSQLite(source, path, tables=None):
+    tables = tables or sorted(SNAPSHOT_TABLES)
+    conn = sqlite3.connect(path)
+    conn.execute('create table if not exists ref_chroms ' +
+        '(id integer primary key, name text unique)')
+    chromIds = dict(conn.execute('select name, id from ref_chroms'))
+
+    for table in tables:
+        (chromCol, startCol, endCol) = SNAPSHOT_TABLES[table]
+        cursor = source.cursor()
+        cursor.execute('select * from ' + table)
+        columns = [str(d[0]) for d in cursor.description]
+        rows = cursor.fetchall()
+        cursor.close()
+
+        types = ['TEXT'] * len(columns)
+        for c in range(len(columns)):
+            for row in rows:
+                if row[c] is not None:
+                    types[c] = sqliteType(row[c])
+                    break
+
+        conn.execute('drop table if exists ' + table)
+        conn.execute('drop table if exists ' + table + '_rtree')
+        conn.execute('create table ' + table + ' (' + ', '.join(
+            '"' + c + '" ' + t for (c, t) in zip(columns, types)) + ')')
+        conn.executemany('insert into ' + table + ' values (' +
+            ', '.join(['?'] * len(columns)) + ')', rows)
+
+        if (startCol == endCol):
+            conn.execute('create index ' + table + '_chrom_pos on ' + table +
+                ' (' + chromCol + ', ' + startCol + ')')
+        else:
+            for row in rows:
+                chrom = str(row[columns.index(chromCol)])
+                if chrom not in chromIds:
+                    chromIds[chrom] = len(chromIds) + 1
+                    conn.execute('insert into ref_chroms values (?, ?)',
+                        (chromIds[chrom], chrom))
+            conn.execute('create virtual table ' + table + '_rtree using ' +
+                'rtree_i32(id, minChrom, maxChrom, minPos, maxPos)')
+            conn.execute('insert into ' + table + '_rtree select t.rowid, ' +
+                'c.id, c.id, t.' + startCol + ', t.' + endCol + ' from ' +
+                table + ' t join ref_chroms c on c.name = t.' + chromCol)
+        conn.commit()
+        print(f"{table}: {len(rows)} rows")
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    import utils as u
+    if len(sys.argv) > 1:
+        source = u.db_connect()
+        exportSQLite(source, sys.argv[1], tables=(sys.argv[2:] or None))
+        source.close()
+    else:
+        print("Usage: python backends.py <sqlite_file> [table ...]")
+
+### EOF
@@ -10,12 +10,241 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import sys
 import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
 import file_utils as fu
 import annotate as ann
+import utils as u
+from reference import Reference
+from snapshot import openSnapshot
+
+"""Record annotators in pipeline order, as run by the fused engine
+Each entry is (label, annotator, log writer, keyword arguments); the
+keyword arguments are passed to both the annotator and the log writer.
+"""
+PIPELINE = [
+    ('dbSNP', ann.annotateDbSnp, ann.writeDbSnpLog, {}),
+    ('BigRefGene', ann.annotateBigRefGene, None, {}),
+    ('refGene', ann.annotateGenes, ann.writeGenesLog,
+        {'table': 'refGene', 'promoter_offset': 500}),
+    ('Cytoband', ann.annotateCytoband, ann.writeOverlapLog,
+        {'table': 'cytoBand'}),
+    ('gadAll', ann.annotateGadAll, ann.writeOverlapLog, {'table': 'gadAll'}),
+    ('GwasCatalog', ann.annotateGwasCatalog, ann.writeOverlapLog,
+        {'table': 'gwasCatalog'}),
+    ('miRNA', ann.annotateMiRNA, ann.writeMiRNALog, {'table': 'targetScanS'}),
+    ('HUGO Gene Nomenclature Committee', ann.annotateHugo,
+        ann.writeOverlapLog, {'table': 'hugo'}),
+    ('dgv_Cnv', ann.annotateCnv, ann.writeOverlapLog, {'table': 'dgv_Cnv'}),
+    ('abParts_IG_T_CelReceptors', ann.annotateCnv, ann.writeOverlapLog,
+        {'table': 'abParts_IG_T_CelReceptors'}),
+    ('mcCarroll_Cnv', ann.annotateCnv, ann.writeOverlapLog,
+        {'table': 'mcCarroll_Cnv'}),
+    ('conrad_Cnv', ann.annotateCnv, ann.writeOverlapLog,
+        {'table': 'conrad_Cnv'}),
+    ('genomicSuperDups', ann.annotateGenomicSuperDups, ann.writeOverlapLog,
+        {'table': 'genomicSuperDups'}),
+    ('addOverlapWithTfbsConsSites', ann.annotateTfbsConsSites,
+        ann.writeOverlapLog, {'table': 'tfbsConsSites'}),
+]
+
+
+"""Batched lookups run over each block of records before it is annotated
+"""
+PREFETCH = [ann.prefetchDbSnp]
+
+
+"""Run every record annotator over lines, yielding the annotated lines
+Header lines pass through unchanged; counts holds one Counter per stage.
+"""
+def annotateLines(lines, refdb, counts, inds, sep='\t'):
+    for block in ann.readBlocks(lines, sep):
+        records = [fields for (fields, header) in block if header is None]
+        for prefetch in PREFETCH:
+            prefetch(records, refdb, inds)
+        for (fields, header) in block:
+            if header is not None:
+                yield header
+                continue
+            for (stage, stage_counts) in zip(PIPELINE, counts):
+                (label, annotate, writeLog, kwargs) = stage
+                fields = annotate(fields, refdb, stage_counts, inds, **kwargs)
+            yield '\t'.join(fields)
+
+
+"""Write the per-stage counts to infile.count.log in pipeline order
+"""
+def writeCountLog(infile, counts):
+    fh_log = open(infile + '.count.log', 'w')
+    for (stage, stage_counts) in zip(PIPELINE, counts):
+        (label, annotate, writeLog, kwargs) = stage
+        if writeLog is not None:
+            writeLog(fh_log, stage_counts, **kwargs)
+        print(f"{label} - done.")
+    fh_log.close()
+
+
+"""Single-pass annotation
+Parses each VCF record once, runs every record annotator on it in memory
+against one Reference, and writes the .annot.vcf and .count.log
+once. Produces the same output as the staged run. If lines is given
+(e.g. a streams.s3Lines stream) records are read from it rather than
+from infile, which then only names the output files. If out is given
+(e.g. a sinks.S3MultipartSink) the annotated records are written to it
+instead of the .annot.vcf; the caller closes it.
+"""
+def runFused(infile, format='vcf', sep='\t', lines=None, out=None):
+
+    print("Running fused . . .")
+
+    inds = ann.getFormatSpecificIndices(format=format)
+    counts = [Counter() for stage in PIPELINE]
+
+    refdb = Reference(u.db_connect())
+
+    fh = open(infile) if (lines is None) else lines
+    fh_out = open(infile + '.annot', 'w') if (out is None) else out
+    for line in annotateLines(fh, refdb, counts, inds, sep):
+        fh_out.write(line + '\n')
+    fh.close()
+    refdb.close()
+
+    writeCountLog(infile, counts)
+
+    if out is None:
+        fh_out.close()
+        finalout = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+        os.rename(infile + '.annot', finalout)
+
+
+"""Split the lines of a VCF into shards of consecutive lines
+Shards break wherever the chromosome changes, so each worker loads a
+chromosome's reference rows once; with shard_size set, shards are
+instead fixed runs of that many records. Header lines stay with the
+shard that follows them.
+"""
+def shardLines(lines, inds, shard_size=None, sep='\t'):
+    shard = []
+    records = 0
+    chrom = None
+    for line in lines:
+        if not ann.isHeaderLine(line.strip()):
+            if shard_size:
+                boundary = (records >= shard_size)
+            else:
+                lineChrom = line.split(sep)[inds[0]].strip()
+                boundary = (records > 0) and (lineChrom != chrom)
+                chrom = lineChrom
+            if boundary:
+                yield shard
+                shard = []
+                records = 0
+            records = records + 1
+        shard.append(line)
+    if shard:
+        yield shard
+
 
-def run(infile, format):
+shardReference = None
+
+"""Open the Reference a pool worker keeps for all of its shards
+"""
+def initShardWorker():
+    global shardReference
+    shardReference = Reference(u.db_connect())
+
+
+"""Annotate one shard in a pool worker
+Returns the annotated lines and one Counter per pipeline stage.
+"""
+def annotateShard(lines, format='vcf', sep='\t'):
+    inds = ann.getFormatSpecificIndices(format=format)
+    counts = [Counter() for stage in PIPELINE]
+    annotated = list(annotateLines(lines, shardReference, counts, inds, sep))
+    return (annotated, counts)
+
+
+"""Parallel annotation
+Splits the input into shards (see shardLines), annotates them in a pool
+of worker processes, each with its own Reference, and writes the results
+back in original record order. Per-stage counts are summed across shards,
+so the .count.log matches the serial run. lines and out are as for
+runFused.
+
+Shards are read from the input only as the pool has room for them: at
+most two per worker are outstanding, and the oldest is written out
+before another is read, so memory stays bounded (by shard_size, if set)
+however large a streamed input is.
+"""
+def runParallel(infile, format='vcf', workers=None, shard_size=None,
+    sep='\t', lines=None, out=None):
+
+    workers = workers or os.cpu_count()
+    print(f"Running parallel with {workers} workers . . .")
+
+    inds = ann.getFormatSpecificIndices(format=format)
+    counts = [Counter() for stage in PIPELINE]
+
+    def writeShard(future):
+        (annotated, shard_counts) = future.result()
+        for line in annotated:
+            fh_out.write(line + '\n')
+        for (total, stage_counts) in zip(counts, shard_counts):
+            total.update(stage_counts)
+
+    fh = open(infile) if (lines is None) else lines
+    fh_out = open(infile + '.annot', 'w') if (out is None) else out
+    with ProcessPoolExecutor(max_workers=workers,
+        initializer=initShardWorker) as executor:
+        # Futures in submission order, so results are written in order
+        pending = deque()
+        for shard in shardLines(fh, inds, shard_size, sep):
+            pending.append(executor.submit(annotateShard, shard, format, sep))
+            if (len(pending) >= 2 * workers):
+                writeShard(pending.popleft())
+        while pending:
+            writeShard(pending.popleft())
+    fh.close()
+
+    writeCountLog(infile, counts)
+
+    if out is None:
+        fh_out.close()
+        finalout = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+        os.rename(infile + '.annot', finalout)
+
+
+"""Load what every run needs up front
+Called by a parent process before it forks workers, so the reference
+snapshot (if configured) is opened once and its mappings are shared.
+"""
+def preload():
+    snapshot = u.getSetting('snapshot_dir')
+    if snapshot:
+        openSnapshot(snapshot)
+
+
+"""Annotate infile, or the records in lines (see runFused) written to
+files named after infile, or with the annotated records written to out
+"""
+def run(infile, format, fused=False, workers=None, shard_size=None,
+    lines=None, out=None):
+
+    if workers and (workers > 1):
+        return runParallel(infile, format=format, workers=workers,
+            shard_size=shard_size, lines=lines, out=out)
+    if fused:
+        return runFused(infile, format=format, lines=lines, out=out)
+
+    if lines is not None:
+        # The staged run rereads its input once per stage; spool it first
+        fh = open(infile, 'w')
+        for line in lines:
+            fh.write(line)
+        fh.close()
+        lines.close()
 
     print("Running . . .")
 
@@ -118,4 +347,12 @@ def run(infile, format):
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile + '.annot', finalout)
 
+    if out is not None:
+        # Stages write files; hand the finished result to out
+        fh = open(finalout)
+        for line in fh:
+            out.write(line)
+        fh.close()
+        os.remove(finalout)
+
 ### EOF
\ No newline at end of file
@@ -15,7 +15,6 @@ import linecache
 import csv
 import os
 import shutil
-import sys
 
 import itertools, operator
 
@@ -0,0 +1,84 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory interval index for point-in-interval lookups
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from bisect import bisect_right
+
+
+"""Sorted interval index
+Intervals are kept sorted by start next to a running maximum of their
+ends, so a point query bisects to the last start <= pos and only walks
+back while the running maximum still reaches pos. Matches come back in
+the order the rows were loaded.
+"""
+class IntervalIndex(object):
+    def __init__(self, starts, ends, maxEnds, ordinals, rows):
+        self.starts = starts
+        self.ends = ends
+        self.maxEnds = maxEnds
+        self.ordinals = ordinals
+        self.rows = rows
+        self.derivedValues = {}
+
+    """Build the index from result rows, given the start and end columns
+    """
+    @classmethod
+    def fromRows(cls, rows, startcol, endcol, pad=0):
+        order = sorted(range(len(rows)), key=lambda i: int(rows[i][startcol]))
+        starts = []
+        ends = []
+        maxEnds = []
+        maxEnd = None
+        for i in order:
+            start = int(rows[i][startcol]) - pad
+            end = int(rows[i][endcol]) + pad
+            maxEnd = end if (maxEnd is None or end > maxEnd) else maxEnd
+            starts.append(start)
+            ends.append(end)
+            maxEnds.append(maxEnd)
+
+        return cls(starts, ends, maxEnds, order, [rows[i] for i in order])
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Positions (in sorted order) of the intervals overlapping lo..hi,
+    in load order
+    """
+    def findRange(self, lo, hi):
+        hits = []
+        i = bisect_right(self.starts, hi) - 1
+        while (i >= 0) and (self.maxEnds[i] >= lo):
+            if (self.ends[i] >= lo):
+                hits.append(i)
+            i = i - 1
+        hits.sort(key=lambda i: self.ordinals[i])
+        return hits
+
+    """Positions (in sorted order) of the intervals with
+    (start - pad) <= pos <= (end + pad)
+    """
+    def find(self, pos, pad=0):
+        return self.findRange(pos - pad, pos + pad)
+
+    """Value computed by build from the row at position i, cached for the
+    life of the index; an index holds one kind of derived value
+    """
+    def derived(self, i, build):
+        value = self.derivedValues.get(i)
+        if value is None:
+            value = self.derivedValues[i] = build(self.rows[i])
+        return value
+
+    """Rows whose (padded) interval contains pos, in load order
+    """
+    def overlapping(self, pos, pad=0):
+        return [self.rows[i] for i in self.find(pos, pad)]
+
+### EOF
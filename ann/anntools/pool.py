@@ -0,0 +1,138 @@
+# pool.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Process-wide reference database connection pool and secret cache
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import threading
+
+
+"""Value fetched by fetch() and reused for ttl seconds
+Used for the RDS secret, so stages stop calling Secrets Manager for
+every connection; invalidate() forces the next get() to refetch (e.g.
+after the secret was rotated and a login failed).
+"""
+class SecretCache(object):
+    def __init__(self, fetch, ttl=300):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.value = None
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if (self.value is None) or (time.time() >= self.expires):
+                self.value = self.fetch()
+                self.expires = time.time() + self.ttl
+            return self.value
+
+    def invalidate(self):
+        with self.lock:
+            self.value = None
+
+
+"""Bounded pool of warm database connections
+acquire() hands out an idle connection after a health check (check(conn)
+should ping and reconnect, raising if it cannot) or opens a new one with
+connect(); at most size connections are out at once, so concurrent stages
+and jobs in one process cannot exhaust the server's connection limit.
+release() returns a connection for reuse. Connections are per process:
+after a fork the child starts with an empty pool and never touches the
+parent's sockets.
+"""
+class ConnectionPool(object):
+    def __init__(self, connect, check=None, size=4, onFailure=None):
+        self.connect = connect
+        self.check = check
+        self.size = size
+        self.onFailure = onFailure
+        self.cond = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.busy = 0
+
+    def ownedByThisProcess(self):
+        if (self.pid != os.getpid()):
+            # Inherited across fork; the sockets belong to the parent
+            self.reset()
+
+    """Open size connections ahead of the first stage
+    """
+    def warm(self, count=None):
+        count = self.size if (count is None) else min(count, self.size)
+        with self.cond:
+            self.ownedByThisProcess()
+            while (len(self.idle) + self.busy < count):
+                self.idle.append(self.connect())
+
+    def acquire(self, timeout=None):
+        with self.cond:
+            self.ownedByThisProcess()
+            if not self.cond.wait_for(lambda: self.busy < self.size, timeout):
+                raise TimeoutError("No reference database connection free " +
+                    f"after {timeout}s")
+            self.busy = self.busy + 1
+            conn = self.idle.pop() if self.idle else None
+
+        try:
+            return self.healthy(conn)
+        except Exception:
+            with self.cond:
+                self.busy = self.busy - 1
+                self.cond.notify()
+            raise
+
+    """Health-check an idle connection, replacing it if it is dead
+    """
+    def healthy(self, conn):
+        if conn is not None and self.check is not None:
+            try:
+                self.check(conn)
+                return conn
+            except Exception as e:
+                print(f"Reference database connection failed check: {e}")
+                self.discard(conn)
+                if self.onFailure is not None:
+                    self.onFailure()
+                conn = None
+
+        if conn is None:
+            conn = self.connect()
+        return conn
+
+    def release(self, conn):
+        with self.cond:
+            if (self.pid != os.getpid()):
+                return
+            self.busy = self.busy - 1
+            if (len(self.idle) < self.size):
+                self.idle.append(conn)
+                conn = None
+            self.cond.notify()
+        if conn is not None:
+            self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.cond:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self.discard(conn)
+
+### EOF
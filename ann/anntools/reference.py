@@ -0,0 +1,402 @@
+# reference.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Lookups against the annotator reference database
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import utils as u
+from intervals import IntervalIndex
+from transcripts import Transcript
+from snapshot import openSnapshot
+
+DBSNP_BATCH = 500
+
+
+"""Adaptive window size for windowed prefetch
+Keeps a running mean of the gap between successive lookup positions and
+sizes each new window to cover about `variants` of them: dense regions
+get short windows, sparse ones long windows, within minSize..maxSize.
+"""
+class WindowPlanner(object):
+    def __init__(self, variants=256, minSize=10000, maxSize=5000000):
+        self.variants = variants
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.gap = None
+        self.last = None
+
+    def observe(self, chrom, pos):
+        if (self.last is not None) and (self.last[0] == chrom) and \
+            (pos > self.last[1]):
+            gap = pos - self.last[1]
+            self.gap = gap if (self.gap is None) else \
+                (0.75 * self.gap + 0.25 * gap)
+        self.last = (chrom, pos)
+
+    def size(self):
+        if self.gap is None:
+            return self.minSize
+        return int(min(self.maxSize,
+            max(self.minSize, self.gap * self.variants)))
+
+
+"""BigRefGene lookup over one chromosome (or window) of its three tables
+chrom_pos_equal_base and chrom_pos_equal_nobase are hashed by position;
+chrom_pos_unequal keeps its interval index. A probe answers from the
+first table with matching rows, as the tiered queries did, and returns
+each row's collapsed INFO string, computed once per row by collapse.
+"""
+class BigRefGeneIndex(object):
+    def __init__(self, base, nobase, unequal, collapse):
+        self.sources = (base, nobase, unequal)
+        self.collapse = collapse
+
+        # Index positions run in start order, and in load order per start
+        self.base = {}
+        for i in range(len(base)):
+            row = base.rows[i]
+            self.base.setdefault(int(base.starts[i]), []).append(
+                (i, str(row[4]).upper(), str(row[5]).upper()))
+        self.nobase = {}
+        for i in range(len(nobase)):
+            self.nobase.setdefault(int(nobase.starts[i]), []).append(i)
+
+    def lookup(self, pos, ref, alt, compRef, compAlt):
+        (base, nobase, unequal) = self.sources
+        # Case-insensitive, as the database's default collation compares
+        alleles = ((ref.upper(), alt.upper()),
+            (compRef.upper(), compAlt.upper()))
+
+        hits = [i for (i, hapRef, hapAlt) in self.base.get(pos, [])
+            if (hapRef, hapAlt) in alleles]
+        if (len(hits) > 0):
+            return [base.derived(i, self.collapse) for i in hits]
+
+        hits = self.nobase.get(pos, [])
+        if (len(hits) > 0):
+            return [nobase.derived(i, self.collapse) for i in hits]
+
+        return [unequal.derived(i, self.collapse) for i in unequal.find(pos)]
+
+
+"""Reference database lookups for one annotation run
+Wraps a reference backend from utils.db_connect (MySQL or local SQLite);
+every stage goes through one of the lookup methods below rather than
+building SQL itself. Point-in-interval lookups load each table once per
+chromosome into an IntervalIndex and answer from memory instead of
+sending one query per variant. Only the most recent chromosome is kept
+per table, which suits position-sorted VCFs.
+
+With prefetch='window' (the prefetch setting in ann_config.ini) tables
+are instead fetched one genomic window at a time: a lookup outside the
+current window issues a single range query for every row overlapping
+the next window, sized by a WindowPlanner from the variant density, and
+the variants that follow are resolved against that buffer. This bounds
+memory on large tables while still replacing per-variant round trips.
+
+When a binary snapshot is configured (snapshot_dir in ann_config.ini),
+indexes for exported tables are served straight from its memory-mapped
+files and the database is not queried for them at all. That includes
+dbSNP, whose blocks are resolved against the mapped chromosome instead
+of IN-list queries, and the per-chromosome tfbsConsSites tables.
+"""
+class Reference(object):
+    def __init__(self, db, indexed=True, snapshot=None, prefetch=None):
+        self.db = db
+        self.indexed = indexed
+        self.indexes = {}
+        self.windows = {}
+        self.planners = {}
+        self.columns = {}
+        self.dbSnpRows = {}
+        self.tableChroms = {}
+        self.bigRefGeneIndex = None
+        self.prefetch = prefetch or u.getSetting('prefetch', 'chromosome')
+
+        snapshot = snapshot or u.getSetting('snapshot_dir')
+        self.snapshot = openSnapshot(snapshot) if snapshot else None
+
+    """Index of one chromosome of a table, loaded on first use
+    """
+    def getIndex(self, table, chromCol, chrom, startCol, endCol):
+        key = (table, chromCol, startCol, endCol)
+        cached = self.indexes.get(key)
+        if (cached is not None) and (cached[0] == chrom):
+            return cached[1]
+
+        index = self.snapshotIndex(table, chromCol, chrom, startCol, endCol)
+        if index is None:
+            (columns, rows) = self.db.chromosome(table, chromCol, chrom)
+            index = IntervalIndex.fromRows(rows, columns.index(startCol),
+                columns.index(endCol))
+
+        self.indexes[key] = (chrom, index)
+        return index
+
+    """Index of one chromosome of a table from the snapshot, if it has one
+    """
+    def snapshotIndex(self, table, chromCol, chrom, startCol, endCol):
+        if (self.snapshot is None) or (chromCol is None):
+            return None
+        return self.snapshot.getIndex(table, chrom, startCol, endCol)
+
+    def snapshotHas(self, table):
+        return (self.snapshot is not None) and self.snapshot.hasTable(table)
+
+    """Index of the window of a table covering lo..hi, fetched when the
+    range falls outside the current one
+    """
+    def getWindowIndex(self, table, chromCol, chrom, lo, hi, startCol,
+        endCol):
+
+        key = (table, chromCol, startCol, endCol)
+        planner = self.planners.get(key)
+        if planner is None:
+            planner = self.planners[key] = WindowPlanner()
+        planner.observe(chrom, lo)
+
+        cached = self.windows.get(key)
+        if (cached is not None) and (cached[0] == chrom) and \
+            (cached[1] <= lo) and (hi <= cached[2]):
+            return cached[3]
+
+        index = self.snapshotIndex(table, chromCol, chrom, startCol, endCol)
+        if index is not None:
+            (lo, hi) = (float('-inf'), float('inf'))
+        else:
+            # Windows run forward from lo, as sorted input moves that way
+            hi = hi + planner.size()
+            (columns, rows) = self.db.window(table, chromCol, chrom, lo, hi,
+                startCol, endCol)
+            index = IntervalIndex.fromRows(rows, columns.index(startCol),
+                columns.index(endCol))
+
+        self.windows[key] = (chrom, lo, hi, index)
+        return index
+
+    """Index able to answer lookups over lo..hi, per the prefetch strategy
+    """
+    def getRangeIndex(self, table, chromCol, chrom, lo, hi, startCol,
+        endCol):
+
+        if (self.prefetch == 'window'):
+            return self.getWindowIndex(table, chromCol, chrom, lo, hi,
+                startCol, endCol)
+        return self.getIndex(table, chromCol, chrom, startCol, endCol)
+
+    """All rows of table on chrom overlapping lo..hi (startCol <= hi and
+    endCol >= lo); chromCol None searches the whole table
+    """
+    def overlappingRange(self, table, chromCol, chrom, lo, hi,
+        startCol='chromStart', endCol='chromEnd'):
+
+        if not self.indexed:
+            return self.db.window(table, chromCol, chrom, lo, hi, startCol,
+                endCol)[1]
+
+        index = self.getRangeIndex(table, chromCol, chrom, int(lo), int(hi),
+            startCol, endCol)
+        return [index.rows[i] for i in index.findRange(int(lo), int(hi))]
+
+    """All rows of table on chrom with (startCol - pad) <= pos <=
+    (endCol + pad); chromCol None searches the whole table
+    """
+    def overlapping(self, table, chromCol, chrom, pos,
+        startCol='chromStart', endCol='chromEnd', pad=0):
+
+        if not self.indexed:
+            return self.db.interval(table, chromCol, chrom, pos, startCol,
+                endCol, pad=pad)
+
+        pos = int(pos)
+        index = self.getRangeIndex(table, chromCol, chrom, pos - pad,
+            pos + pad, startCol, endCol)
+        return index.overlapping(pos, pad)
+
+    """Fetch the dbSNP rows at a block of (chrom, pos) positions
+    One IN-list query per chromosome (in chunks of DBSNP_BATCH positions),
+    or lookups in the snapshot's index when it has dbSNP; replaces the
+    previous block.
+    """
+    def prefetchDbSnp(self, positions):
+        byChrom = {}
+        for (chrom, pos) in positions:
+            byChrom.setdefault(str(chrom), set()).add(int(pos))
+
+        self.dbSnpRows = {}
+        if self.snapshotHas('dbSNP'):
+            for (chrom, chromPositions) in byChrom.items():
+                for pos in chromPositions:
+                    self.dbSnpRows[(chrom, pos)] = self.snapshotDbSnp(chrom,
+                        pos)
+            return
+
+        for (chrom, chromPositions) in byChrom.items():
+            chromPositions = sorted(chromPositions)
+            for pos in chromPositions:
+                self.dbSnpRows[(chrom, pos)] = []
+            for i in range(0, len(chromPositions), DBSNP_BATCH):
+                batch = chromPositions[i:i + DBSNP_BATCH]
+                (columns, rows) = self.db.describedQuery('select * from ' +
+                    'dbSNP where CHR = %s AND POS in (' +
+                    ', '.join(['%s'] * len(batch)) + ')', [chrom] + batch)
+                self.dbSnpColumns = (columns.index('POS'),
+                    columns.index('REF'), columns.index('INFO'))
+                posInd = self.dbSnpColumns[0]
+                for row in rows:
+                    self.dbSnpRows[(chrom, int(row[posInd]))].append(row)
+
+    """dbSNP rows at a position, from the snapshot's index of its chromosome
+    """
+    def snapshotDbSnp(self, chrom, pos):
+        columns = self.snapshot.getColumns('dbSNP')
+        if columns is None:
+            return []
+        self.dbSnpColumns = (columns.index('POS'), columns.index('REF'),
+            columns.index('INFO'))
+        index = self.getIndex('dbSNP', 'CHR', chrom, 'POS', 'POS')
+        return index.overlapping(pos)
+
+    """dbSNP entries at a position matching either strand of the reference
+    Answered from the prefetched block when it covers the position, or
+    else from the snapshot if it has dbSNP.
+    """
+    def dbSnp(self, chrom, pos, ref, compRef, varclass):
+        rows = self.dbSnpRows.get((str(chrom), int(pos)))
+        if (rows is None) and self.snapshotHas('dbSNP'):
+            rows = self.snapshotDbSnp(str(chrom), int(pos))
+        if rows:
+            (posInd, refInd, infoInd) = self.dbSnpColumns
+            # Case-insensitive, as the database's default collation compares
+            refs = (ref.upper(), compRef.upper())
+            return [row for row in rows
+                if (str(row[refInd]).upper() in refs) and
+                    (str(row[infoInd]).upper() == varclass.upper())]
+        if rows is not None:
+            return []
+
+        return self.db.query('select * from dbSNP where CHR = %s AND ' +
+            'POS = %s AND (REF = %s OR REF = %s) AND INFO = %s',
+            (str(chrom), int(pos), ref, compRef, varclass))
+
+    """BigRefGene rows for a variant, one query per table in turn:
+    chrom_pos_equal_base, chrom_pos_equal_nobase, chrom_pos_unequal
+    """
+    def bigRefGeneTiers(self, chrom, pos, ref, alt, compRef, compAlt):
+        yield self.db.query('select * from chrom_pos_equal_base where ' +
+            'CHR = %s AND start = %s AND ((haplotypeReference = %s AND ' +
+            'haplotypeAlternate = %s) OR (haplotypeReference = %s AND ' +
+            'haplotypeAlternate = %s))',
+            (str(chrom), int(pos), ref, alt, compRef, compAlt))
+        yield self.db.query('select * from chrom_pos_equal_nobase where ' +
+            'CHR = %s AND start = %s', (str(chrom), int(pos)))
+        yield self.overlapping('chrom_pos_unequal', 'CHR', chrom, pos,
+            'start', 'end')
+
+    """Collapsed BigRefGene INFO strings for a variant, from the first of
+    chrom_pos_equal_base, chrom_pos_equal_nobase and chrom_pos_unequal
+    with matching rows; collapse(row) builds the string for one row
+    """
+    def bigRefGene(self, chrom, pos, ref, alt, compRef, compAlt, collapse):
+        if not self.indexed:
+            for rows in self.bigRefGeneTiers(chrom, pos, ref, alt, compRef,
+                compAlt):
+                if (len(rows) > 0):
+                    return [collapse(row) for row in rows]
+            return []
+
+        pos = int(pos)
+        sources = (
+            self.getRangeIndex('chrom_pos_equal_base', 'CHR', chrom, pos, pos,
+                'start', 'start'),
+            self.getRangeIndex('chrom_pos_equal_nobase', 'CHR', chrom, pos,
+                pos, 'start', 'start'),
+            self.getRangeIndex('chrom_pos_unequal', 'CHR', chrom, pos, pos,
+                'start', 'end'))
+        # Rebuilt whenever a new chromosome or window is loaded
+        if (self.bigRefGeneIndex is None) or \
+            any(a is not b for (a, b) in
+                zip(self.bigRefGeneIndex.sources, sources)):
+            self.bigRefGeneIndex = BigRefGeneIndex(*sources, collapse)
+        return self.bigRefGeneIndex.lookup(pos, ref, alt, compRef, compAlt)
+
+    """Transcripts whose promoter-padded extent contains pos
+    """
+    def genes(self, table, chrom, pos, promoter_offset):
+        return self.overlapping(table, 'chrom', chrom, pos, 'txStart',
+            'txEnd', pad=int(promoter_offset))
+
+    """Transcript models (see transcripts.Transcript) for the transcripts
+    whose promoter-padded extent contains pos; each is parsed once per
+    loaded index
+    """
+    def transcripts(self, table, chrom, pos, promoter_offset):
+        pad = int(promoter_offset)
+        build = lambda row: Transcript(row, pad, self.cpgIslands)
+        if not self.indexed:
+            return [build(row) for row in
+                self.genes(table, chrom, pos, promoter_offset)]
+
+        pos = int(pos)
+        index = self.getRangeIndex(table, 'chrom', chrom, pos - pad,
+            pos + pad, 'txStart', 'txEnd')
+        return [index.derived(i, build) for i in index.find(pos, pad)]
+
+    """CpG islands overlapping lo..hi, as (chrom, chromStart, chromEnd,
+    name), in table order
+    """
+    def cpgIslands(self, chrom, lo, hi):
+        return self.project('cpgIslandExt', self.overlappingRange(
+            'cpgIslandExt', 'chrom', chrom, lo, hi),
+            ['chrom', 'chromStart', 'chromEnd', 'name'])
+
+    """First CpG island containing pos, as (chrom, chromStart, chromEnd, name)
+    """
+    def cpgIsland(self, chrom, pos):
+        rows = self.overlapping('cpgIslandExt', 'chrom', chrom, pos)
+        if (len(rows) == 0):
+            return None
+        return self.project('cpgIslandExt', rows[0:1],
+            ['chrom', 'chromStart', 'chromEnd', 'name'])[0]
+
+    """Conserved TFBS sites containing pos, from the per-chromosome table
+    The database table is searched whole; from a snapshot, the table's
+    one chromosome is looked up by the name it was exported under.
+    """
+    def tfbsSites(self, table, pos):
+        chrom = self.tableChromosome(table)
+        return self.project(table, self.overlapping(table,
+            None if (chrom is None) else 'chrom', chrom, pos),
+            ['chrom', 'chromStart', 'chromEnd', 'name'])
+
+    """The single chromosome of a per-chromosome table in the snapshot, or
+    None to search the table as a whole
+    """
+    def tableChromosome(self, table):
+        if table not in self.tableChroms:
+            chroms = self.snapshot.chromosomes(table) \
+                if self.snapshotHas(table) else []
+            self.tableChroms[table] = chroms[0] if (len(chroms) == 1) \
+                else None
+        return self.tableChroms[table]
+
+    """Pick columns, by name, out of full table rows
+    """
+    def project(self, table, rows, columns):
+        if (table not in self.columns) and self.snapshotHas(table):
+            self.columns[table] = self.snapshot.getColumns(table)
+        if self.columns.get(table) is None:
+            (names, ignored) = self.db.describedQuery('select * from ' +
+                table + ' where 0 = 1')
+            self.columns[table] = names
+        inds = [self.columns[table].index(c) for c in columns]
+        return [tuple(row[i] for i in inds) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+### EOF
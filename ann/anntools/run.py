@@ -13,6 +13,8 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import sys
 import time
 import driver
+import streams
+import sinks
 import os
 import boto3
 import datetime
@@ -20,6 +22,7 @@ import json
 from configparser import ConfigParser
 from flask import session
 from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
 
 config = ConfigParser()
 # Get the directory of the current script
@@ -46,12 +49,27 @@ class Timer(object):
     if self.verbose:
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+"""boto3 clients and resources, created once per process and reused by
+every job a long-lived worker runs
+"""
+aws_clients = {}
+
+def aws_client(service, resource=False, **kwargs):
+    key = (os.getpid(), service, resource, tuple(sorted(kwargs.items())))
+    if key not in aws_clients:
+        if resource:
+            aws_clients[key] = boto3.resource(service, **kwargs)
+        else:
+            aws_clients[key] = boto3.client(service, **kwargs)
+    return aws_clients[key]
+
 def upload_to_s3(local_file, bucket_name, s3_key):
-    s3_client = boto3.client('s3')
+    s3_client = aws_client('s3')
     s3_client.upload_file(local_file, bucket_name, s3_key)
 
-def update_dynamodb_job(job_id, s3_key_results, s3_key_log):
-     dynamodb = boto3.resource('dynamodb')
+def update_dynamodb_job(job_id, s3_key_results, s3_key_log, user_id, email,
+     s3_bucket):
+     dynamodb = aws_client('dynamodb', resource=True)
      table_name = config.get('DynamoDB','table_name')
      table = dynamodb.Table(table_name)
      completion_time = datetime.datetime.now()
@@ -72,7 +90,7 @@ def update_dynamodb_job(job_id, s3_key_results, s3_key_log):
      )
 
      region_name = config.get('AWS', 'region_name')
-     sns_client = boto3.client('sns', region_name = region_name)
+     sns_client = aws_client('sns', region_name = region_name)
      topic_arn_results_path = config.get('SNS', 'topic_arn_results')
      topic_arn_archive = config.get('SNS', 'topic_arn_archive')
      # https://stackoverflow.com/questions/35758924/how-do-we-query-on-a-secondary-index-of-dynamodb-using-boto3
@@ -108,34 +126,77 @@ def update_dynamodb_job(job_id, s3_key_results, s3_key_log):
      elif user_role_extract == "premium_user":
           print("Notification not sent")
 
+"""Annotate one job's input file, upload the results and log to S3, and
+record completion; called once per process by the command line below,
+or repeatedly by the annotator's pre-forked workers. With s3_input
+(bucket, key) the input is streamed from S3 (gunzipped if need be)
+instead of read from input_file_name, which only names the outputs.
+"""
+def run_job(input_file_name, email, s3_input=None):
+        user_id = input_file_name[8:44]
+        input_file = input_file_name.split('/')[-1].split('.')[0]
+        fused = config.getboolean('AnnTools', 'fused', fallback=False)
+        workers = config.getint('AnnTools', 'workers', fallback=1)
+        shard_size = config.get('AnnTools', 'shard_size', fallback='')
+        lines = None
+        if s3_input is not None:
+                lines = streams.s3Lines(aws_client('s3'), *s3_input)
+        job_id = input_file_name.split('/')[-2]
+        s3_bucket=config.get('S3', 'results_bucket')
+        s3_folder = f'koyya/{user_id}/{job_id}/'
+        input_file_base = os.path.dirname(input_file_name)
+        results_file = f'/home/ec2-user/mpcs-cc/gas/ann/{input_file_base}/{input_file}.annot.vcf'
+        s3_key_results = f'{s3_folder}{input_file}.annot.vcf'
+        log_file = f'/home/ec2-user/mpcs-cc/gas/ann/{input_file_base}/{input_file}.vcf.count.log'
+        s3_key_log = f'{s3_folder}{input_file}.vcf.count.log'
+
+        # Upload the results file part by part while annotation runs
+        results = None
+        if config.getboolean('AnnTools', 'stream_output', fallback=False):
+                results = sinks.S3MultipartSink(aws_client('s3'), s3_bucket,
+                        s3_key_results,
+                        part_size=config.getint('AnnTools', 'upload_part_mb',
+                                fallback=8) * 1024 * 1024,
+                        concurrency=config.getint('AnnTools',
+                                'upload_concurrency', fallback=4))
+        with Timer():
+                try:
+                        driver.run(streams.uncompressedName(input_file_name),
+                                'vcf', fused=fused,
+                                workers=(workers if workers > 0 else os.cpu_count()),
+                                shard_size=(int(shard_size) if shard_size else None),
+                                lines=lines, out=results)
+                except Exception:
+                        if results is not None:
+                                results.abort()
+                        raise
+
+                # Upload the log file alongside the last of the results
+                with ThreadPoolExecutor(max_workers=2) as uploads:
+                        log_upload = uploads.submit(upload_to_s3, log_file,
+                                s3_bucket, s3_key_log)
+                        if results is not None:
+                                results.close()
+                        else:
+                                upload_to_s3(results_file, s3_bucket,
+                                        s3_key_results)
+                        log_upload.result()
+
+        update_dynamodb_job(job_id, s3_key_results, s3_key_log, user_id,
+                email, s3_bucket)
+
+        # clean up local job files
+        if results is None:
+                os.remove(results_file)
+        os.remove(log_file)
+
 if __name__ == '__main__':
         # Call the AnnTools pipeline
-        if len(sys.argv) > 1:
-                input_file_name = sys.argv[2]
-                user_id = input_file_name[8:44]
-                email = sys.argv[3]
-                input_file = input_file_name.split('/')[-1].split('.')[0]
-                with Timer():
-                        driver.run(input_file_name, 'vcf')
-                # Upload the results file
-                job_id = input_file_name.split('/')[-2]
-                s3_bucket=config.get('S3', 'results_bucket')
-                s3_folder = f'koyya/{user_id}/{job_id}/'
-                input_file_base = os.path.dirname(input_file_name)
-                results_file = f'/home/ec2-user/mpcs-cc/gas/ann/{input_file_base}/{input_file}.annot.vcf'
-                s3_key_results = f'{s3_folder}{input_file}.annot.vcf'
-                upload_to_s3(results_file, s3_bucket, s3_key_results)
-
-                # Upload the log file
-                log_file = f'/home/ec2-user/mpcs-cc/gas/ann/{input_file_base}/{input_file}.vcf.count.log'
-                s3_key_log = f'{s3_folder}{input_file}.vcf.count.log'
-                upload_to_s3(log_file, s3_bucket, s3_key_log)
-
-                update_dynamodb_job(job_id, s3_key_results, s3_key_log)
-
-                # clean up local job files
-                os.remove(results_file)
-                os.remove(log_file)
+        if len(sys.argv) > 5:
+                # Stream the input from s3://<argv[4]>/<argv[5]>
+                run_job(sys.argv[2], sys.argv[3], (sys.argv[4], sys.argv[5]))
+        elif len(sys.argv) > 1:
+                run_job(sys.argv[2], sys.argv[3])
         else:
                 print("A valid .vcf file must be provided as input to this program.")
 
@@ -0,0 +1,125 @@
+# sinks.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Streaming output of annotated records to S3 while the run is going
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# S3 rejects multipart parts under 5 MB, other than the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
+
+"""Writable text stream into an S3 object, uploaded in parts as they fill
+
+Text written is buffered until part_size bytes have accumulated; that
+part is then handed to a pool of concurrency upload threads and writing
+carries on, so uploading overlaps annotation. At most concurrency parts
+are in flight; a writer that gets further ahead than that waits for one
+of them, which bounds memory at roughly (concurrency + 1) * part_size.
+close() uploads the remainder and completes the upload; outputs smaller
+than one part go up with a single put_object instead. abort() (or any
+failed part) abandons the multipart upload so S3 keeps no orphaned parts.
+"""
+class S3MultipartSink(object):
+    def __init__(self, s3_client, bucket, key, part_size=PART_SIZE,
+        concurrency=4):
+
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.buffer = []
+        self.buffered = 0
+        self.upload_id = None
+        self.parts = []
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.closed = False
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        if (self.buffered >= self.part_size):
+            self.flushPart()
+        return len(text)
+
+    def takeBuffer(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        return data
+
+    """Hand the buffered bytes to an upload thread as the next part
+    """
+    def flushPart(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket,
+                Key=self.key)
+            self.upload_id = response['UploadId']
+
+        # Fail fast if an earlier part already failed
+        for (number, future) in self.parts:
+            if future.done() and (future.exception() is not None):
+                self.abort()
+                raise future.exception()
+
+        self.slots.acquire()
+        number = len(self.parts) + 1
+        future = self.executor.submit(self.uploadPart, self.upload_id,
+            number, self.takeBuffer())
+        self.parts.append((number, future))
+
+    def uploadPart(self, upload_id, number, data):
+        try:
+            response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+                UploadId=upload_id, PartNumber=number, Body=data)
+            return response['ETag']
+        finally:
+            self.slots.release()
+
+    """Upload what is left and finish the object
+    """
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key,
+                    Body=self.takeBuffer())
+                return
+
+            if self.buffered:
+                self.flushPart()
+            etags = [(number, future.result())
+                for (number, future) in self.parts]
+            self.s3.complete_multipart_upload(Bucket=self.bucket,
+                Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag}
+                    for (number, etag) in etags]})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def abort(self):
+        self.closed = True
+        self.buffer = []
+        self.buffered = 0
+        if self.upload_id is not None:
+            upload_id = self.upload_id
+            self.upload_id = None
+            self.executor.shutdown(wait=True)
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=upload_id)
+
+### EOF
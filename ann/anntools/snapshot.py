@@ -0,0 +1,360 @@
+# snapshot.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Versioned binary snapshot of the annotator reference tables
+#
+# Export:  python snapshot.py <snapshot_dir> [version] [table ...]
+#
+# Layout:  <snapshot_dir>/<version>/<table>/<chrom>.snap, plus a CURRENT
+# file naming the version readers should open. Each .snap file holds one
+# chromosome of one table as int32 arrays (rows sorted by start, their
+# original order, ends and running max ends, and one array per column)
+# followed by a dictionary-encoded string pool. Files are mapped read-only,
+# so every annotator process on a box shares one page-cached copy.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import mmap
+import json
+import time
+import struct
+from array import array
+
+from intervals import IntervalIndex
+
+MAGIC = b'ANNSNAP1'
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+# Stored for NULL in an int32 column, so it is not a value one can hold
+NULL_INT = INT32_MIN
+
+"""Reference tables and their (chromosome, start, end) columns
+"""
+SNAPSHOT_TABLES = {
+    'dbSNP': ('CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start', 'start'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+}
+for chrIndex in [str(i) for i in range(1, 23)] + ['X', 'Y']:
+    SNAPSHOT_TABLES['tfbsConsSites' + chrIndex] = \
+        ('chrom', 'chromStart', 'chromEnd')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+"""Column storage type: int32 value (NULL as NULL_INT), pooled string or
+pooled bytes
+"""
+def columnType(values):
+    if all((v is None) or (isinstance(v, int) and not isinstance(v, bool) and
+        NULL_INT < v <= INT32_MAX) for v in values):
+        return 'i'
+    if all((v is None) or isinstance(v, (bytes, bytearray)) for v in values):
+        return 'b'
+    return 's'
+
+
+"""Write one chromosome of one table as a .snap file
+"""
+def writeSnapshotFile(path, version, table, chrom, columns, rows,
+    startCol, endCol):
+
+    startInd = columns.index(startCol)
+    endInd = columns.index(endCol)
+    order = sorted(range(len(rows)), key=lambda i: int(rows[i][startInd]))
+
+    ordinals = array('i', order)
+    starts = array('i')
+    ends = array('i')
+    maxEnds = array('i')
+    maxEnd = None
+    for i in order:
+        end = int(rows[i][endInd])
+        maxEnd = end if (maxEnd is None or end > maxEnd) else maxEnd
+        starts.append(int(rows[i][startInd]))
+        ends.append(end)
+        maxEnds.append(maxEnd)
+
+    # Dictionary-encode every non-integer column into one string pool
+    pool = []
+    pooled = {}
+    types = []
+    data = []
+    for c in range(len(columns)):
+        values = [rows[i][c] for i in order]
+        ctype = columnType(values)
+        col = array('i')
+        for v in values:
+            if (ctype == 'i'):
+                col.append(NULL_INT if v is None else v)
+            elif v is None:
+                col.append(-1)
+            else:
+                key = bytes(v) if (ctype == 'b') else str(v).encode('utf-8')
+                if key not in pooled:
+                    pooled[key] = len(pool)
+                    pool.append(key)
+                col.append(pooled[key])
+        types.append(ctype)
+        data.append(col)
+
+    poolOffsets = array('i', [0])
+    for p in pool:
+        poolOffsets.append(poolOffsets[-1] + len(p))
+
+    header = json.dumps({
+        'version': version,
+        'table': table,
+        'chrom': chrom,
+        'rows': len(rows),
+        'columns': columns,
+        'types': types,
+        'startCol': startCol,
+        'endCol': endCol,
+        'pool': len(pool),
+        'byteorder': sys.byteorder,
+    }).encode('utf-8')
+    header = header + b' ' * (-len(header) % 4)
+
+    tmp = path + '.tmp'
+    fh = open(tmp, 'wb')
+    fh.write(MAGIC)
+    fh.write(struct.pack('<i', len(header)))
+    fh.write(header)
+    for a in [ordinals, starts, ends, maxEnds] + data + [poolOffsets]:
+        a.tofile(fh)
+    for p in pool:
+        fh.write(p)
+    fh.close()
+    os.rename(tmp, path)
+
+
+"""Export reference tables from the database into a new snapshot version
+"""
+def exportSnapshot(conn, root, version=None, tables=None):
+    version = version or time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    tables = tables or sorted(SNAPSHOT_TABLES)
+    cursor = conn.cursor()
+
+    for table in tables:
+        (chromCol, startCol, endCol) = SNAPSHOT_TABLES[table]
+        tabledir = os.path.join(root, version, table)
+        os.makedirs(tabledir, exist_ok=True)
+
+        cursor.execute('select distinct ' + chromCol + ' from ' + table + ';')
+        chroms = [str(row[0]) for row in cursor.fetchall()]
+        for chrom in chroms:
+            cursor.execute('select * from ' + table + ' where ' + chromCol +
+                '="' + chrom + '";')
+            rows = cursor.fetchall()
+            columns = [str(d[0]) for d in cursor.description]
+            writeSnapshotFile(os.path.join(tabledir, chrom + '.snap'),
+                version, table, chrom, columns, rows, startCol, endCol)
+        print(f"{table}: {len(chroms)} chromosomes")
+
+    # Publish the new version only once every file is in place
+    current = os.path.join(root, 'CURRENT')
+    fh = open(current + '.tmp', 'w')
+    fh.write(version + '\n')
+    fh.close()
+    os.rename(current + '.tmp', current)
+    return version
+
+
+"""Row accessor over a mapped snapshot file
+"""
+class SnapshotRows(object):
+    def __init__(self, snapfile):
+        self.snapfile = snapfile
+
+    def __len__(self):
+        return self.snapfile.rows
+
+    def __getitem__(self, i):
+        return self.snapfile.row(i)
+
+
+"""One read-only memory-mapped .snap file
+"""
+class SnapshotFile(object):
+    def __init__(self, path):
+        fh = open(path, 'rb')
+        self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+
+        if (self.mm[0:8] != MAGIC):
+            raise SnapshotError(f"Not a reference snapshot file: {path}")
+        (headerLen,) = struct.unpack('<i', self.mm[8:12])
+        header = json.loads(self.mm[12:12 + headerLen].decode('utf-8'))
+        if (header['byteorder'] != sys.byteorder):
+            raise SnapshotError(f"Snapshot byte order mismatch: {path}")
+
+        self.version = header['version']
+        self.table = header['table']
+        self.chrom = header['chrom']
+        self.rows = header['rows']
+        self.columns = header['columns']
+        self.types = header['types']
+        self.startCol = header['startCol']
+        self.endCol = header['endCol']
+
+        view = memoryview(self.mm)
+        offset = 12 + headerLen
+        arrays = []
+        for i in range(4 + len(self.columns)):
+            arrays.append(view[offset:offset + 4 * self.rows].cast('i'))
+            offset = offset + 4 * self.rows
+        (self.ordinals, self.starts, self.ends, self.maxEnds) = arrays[0:4]
+        self.data = arrays[4:]
+        self.poolOffsets = view[offset:offset + 4 * (header['pool'] + 1)].cast('i')
+        self.poolBase = offset + 4 * (header['pool'] + 1)
+        self.view = view
+
+    def pooled(self, i, ctype):
+        if (i < 0):
+            return None
+        value = bytes(self.view[self.poolBase + self.poolOffsets[i]:
+            self.poolBase + self.poolOffsets[i + 1]])
+        return value if (ctype == 'b') else value.decode('utf-8')
+
+    """Row i (in start order) as a tuple in table column order
+    """
+    def row(self, i):
+        return tuple(self.pooled(col[i], ctype) if (ctype != 'i') else
+            (None if col[i] == NULL_INT else col[i])
+            for (col, ctype) in zip(self.data, self.types))
+
+    """Interval index over the mapped arrays; nothing is copied
+    """
+    def index(self):
+        return IntervalIndex(self.starts, self.ends, self.maxEnds,
+            self.ordinals, SnapshotRows(self))
+
+
+"""A published snapshot version
+Mapped files are shared by every Reference in the process.
+"""
+class Snapshot(object):
+    def __init__(self, root, version=None):
+        if version is None:
+            version = currentVersion(root)
+        self.root = root
+        self.version = version
+        self.files = {}
+
+    def hasTable(self, table):
+        return os.path.isdir(os.path.join(self.root, self.version, table))
+
+    """Chromosomes of a table in the snapshot (those with any rows)
+    """
+    def chromosomes(self, table):
+        tabledir = os.path.join(self.root, self.version, table)
+        if not os.path.isdir(tabledir):
+            return []
+        return sorted(name[:-len('.snap')] for name in os.listdir(tabledir)
+            if name.endswith('.snap'))
+
+    """Column names of a table, from any one of its files; None if the
+    table was not exported or has no rows
+    """
+    def getColumns(self, table):
+        chroms = self.chromosomes(table)
+        if (len(chroms) == 0):
+            return None
+        return self.getFile(table, chroms[0]).columns
+
+    """Mapped file for one chromosome of a table
+    None if the table was not exported; an empty chromosome has no file.
+    """
+    def getFile(self, table, chrom):
+        key = (table, chrom)
+        if key in self.files:
+            return self.files[key]
+
+        snapfile = None
+        path = os.path.join(self.root, self.version, table, str(chrom) + '.snap')
+        if os.path.exists(path):
+            snapfile = SnapshotFile(path)
+            if (snapfile.version != self.version):
+                raise SnapshotError(f"{path} is version {snapfile.version}, " +
+                    f"expected {self.version}")
+        self.files[key] = snapfile
+        return snapfile
+
+    """Interval index for one chromosome of a table
+    None when the snapshot cannot answer for these columns.
+    """
+    def getIndex(self, table, chrom, startCol, endCol):
+        if not self.hasTable(table):
+            return None
+        snapfile = self.getFile(table, chrom)
+        if snapfile is None:
+            return IntervalIndex([], [], [], [], [])
+        if (snapfile.startCol != startCol) or (snapfile.endCol != endCol):
+            return None
+        return snapfile.index()
+
+
+"""Version published in root's CURRENT file
+"""
+def currentVersion(root):
+    fh = open(os.path.join(root, 'CURRENT'))
+    version = fh.read().strip()
+    fh.close()
+    return version
+
+
+openSnapshots = {}
+currentVersions = {}
+
+"""Open (once per process) a snapshot version at root
+Without a version, CURRENT is read on every call, so a newly published
+snapshot is picked up by the next Reference; the version it replaced is
+dropped from the cache (References still using it keep it mapped).
+"""
+def openSnapshot(root, version=None):
+    if version is None:
+        version = currentVersion(root)
+        previous = currentVersions.get(root)
+        if (previous is not None) and (previous != version):
+            openSnapshots.pop((root, previous), None)
+        currentVersions[root] = version
+    key = (root, version)
+    if key not in openSnapshots:
+        openSnapshots[key] = Snapshot(root, version)
+    return openSnapshots[key]
+
+
+if __name__ == '__main__':
+    import utils as u
+    if len(sys.argv) > 1:
+        conn = u.db_connect()
+        version = exportSnapshot(conn, sys.argv[1],
+            version=(sys.argv[2] if len(sys.argv) > 2 else None),
+            tables=(sys.argv[3:] or None))
+        conn.close()
+        print(f"Snapshot {version} written to {sys.argv[1]}")
+    else:
+        print("Usage: python snapshot.py <snapshot_dir> [version] [table ...]")
+
+### EOF
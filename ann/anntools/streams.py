@@ -0,0 +1,64 @@
+# streams.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Streaming VCF input, read straight from S3 as it downloads
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 1024 * 1024
+
+
+"""Raw stream over any object with read(n), such as the body of an S3
+GET, so it can sit under an io.BufferedReader
+"""
+class ReadableStream(io.RawIOBase):
+    def __init__(self, body):
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.body.read(len(buffer))
+        buffer[0:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        io.RawIOBase.close(self)
+
+
+"""Text lines from a binary stream, gunzipped on the fly if it starts
+with the gzip magic number
+Data is read chunk_size bytes at a time, so the first records are
+available as soon as the first chunk arrives.
+"""
+def openLines(body, chunk_size=CHUNK_SIZE):
+    stream = io.BufferedReader(ReadableStream(body), buffer_size=chunk_size)
+    if (stream.peek(2)[0:2] == GZIP_MAGIC):
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    return io.TextIOWrapper(stream, encoding='utf-8')
+
+
+"""Lines of an S3 object (plain or gzipped VCF), read as it downloads
+"""
+def s3Lines(s3_client, bucket, key, chunk_size=CHUNK_SIZE):
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return openLines(response['Body'], chunk_size=chunk_size)
+
+
+"""Input file name with any .gz suffix dropped; output files are named
+after it
+"""
+def uncompressedName(path):
+    return path[:-len('.gz')] if path.endswith('.gz') else path
+
+### EOF
@@ -0,0 +1,109 @@
+# transcripts.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Parsed refGene transcript models for gene annotation
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+from bisect import bisect_right
+
+
+"""Decode a refGene exonStarts/exonEnds value into exonCount integers
+"""
+def exonPositions(value, exonCount):
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8")
+    return [int(x) for x in str(value).split(',')[0:exonCount]]
+
+
+"""One refGene transcript, parsed once from its table row
+Holds the CDS bounds, strand and exons as integer arrays, so a position
+is classified by bisecting the exon starts rather than splitting the
+blobs and walking every exon. CpG islands overlapping the putative
+promoter (promoter_offset upstream of the transcript start, on its
+strand) are looked up once per model through cpgIslands(chrom, lo, hi),
+the first time a position falls in the promoter.
+"""
+class Transcript(object):
+    def __init__(self, row, promoter_offset, cpgIslands):
+        self.row = row
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.exonStarts = exonPositions(row[9], self.exonCount)
+        self.exonEnds = exonPositions(row[10], self.exonCount)
+        self.promoterStart = self.txStart - promoter_offset
+        self.promoterEnd = self.txEnd + promoter_offset
+
+        # Running maximum of the exon ends, in case exons overlap
+        self.maxEnds = []
+        for end in self.exonEnds:
+            self.maxEnds.append(max(end, self.maxEnds[-1]) if self.maxEnds
+                else end)
+        self.sorted = all(self.exonStarts[e] <= self.exonStarts[e + 1]
+            for e in range(len(self.exonStarts) - 1))
+
+        self.cpgIslands = cpgIslands
+        self.promoterCpG = None
+
+    def isNonCoding(self):
+        return (self.cdsStart == self.cdsEnd)
+
+    def inCds(self, pos):
+        return (self.cdsStart <= pos) and (pos <= self.cdsEnd)
+
+    """True if pos is in the putative promoter on the transcript's strand
+    """
+    def inPromoter(self, pos):
+        if (self.strand == '+'):
+            return (self.promoterStart <= pos) and (pos <= self.txStart)
+        if (self.strand == '-'):
+            return (self.txEnd <= pos) and (pos <= self.promoterEnd)
+        return False
+
+    """Indices (ascending) of the exons with start <= pos <= end
+    """
+    def exons(self, pos):
+        if not self.sorted:
+            return [e for e in range(len(self.exonStarts))
+                if (self.exonStarts[e] <= pos) and (pos <= self.exonEnds[e])]
+
+        hits = []
+        e = bisect_right(self.exonStarts, pos) - 1
+        while (e >= 0) and (self.maxEnds[e] >= pos):
+            if (self.exonEnds[e] >= pos):
+                hits.append(e)
+            e = e - 1
+        hits.reverse()
+        return hits
+
+    """Exon number as counted along the transcript's strand
+    """
+    def exonNumber(self, e):
+        if (self.strand == '-'):
+            return self.exonCount - e
+        return e + 1
+
+    """First CpG island (chrom, chromStart, chromEnd, name) containing pos
+    """
+    def cpgIsland(self, pos):
+        if self.promoterCpG is None:
+            self.promoterCpG = []
+            if (self.strand == '+'):
+                self.promoterCpG = self.cpgIslands(self.row[2],
+                    self.promoterStart, self.txStart)
+            elif (self.strand == '-'):
+                self.promoterCpG = self.cpgIslands(self.row[2], self.txEnd,
+                    self.promoterEnd)
+        for cpg in self.promoterCpG:
+            if (int(cpg[1]) <= pos) and (pos <= int(cpg[2])):
+                return cpg
+        return None
+
+### EOF
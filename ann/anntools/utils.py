@@ -13,13 +13,49 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import sqlite3
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
+from configparser import ConfigParser
+
+from backends import MySQLBackend, SQLiteBackend
+from pool import ConnectionPool, SecretCache
+
+config = ConfigParser()
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '../ann_config.ini'))
+
+"""AnnTools setting from the [AnnTools] section of ann_config.ini
+An ANNTOOLS_<NAME> environment variable takes precedence.
+"""
+def getSetting(name, fallback=None):
+    env_name = 'ANNTOOLS_' + name.upper()
+    if (env_name in os.environ):
+        return os.environ[env_name]
+    return config.get('AnnTools', name, fallback=fallback)
+
 
 """Get connection to reference database
+The backend (mysql or sqlite) comes from the backend setting unless
+given; both return an object with the same query interface.
 """
-def db_connect():
+def db_connect(backend=None):
+    backend = backend or getSetting('backend', fallback='mysql')
+    if (backend == 'mysql'):
+        pool = mysql_pool()
+        return MySQLBackend(pool.acquire(), pool=pool)
+    elif (backend == 'sqlite'):
+        path = getSetting('sqlite_path')
+        return SQLiteBackend(sqlite3.connect('file:' + path + '?mode=ro',
+            uri=True))
+    else:
+        raise ValueError(f"Unknown reference backend: {backend}")
+
+
+"""Get the RDS credentials from AWS Secrets Manager
+"""
+def get_rds_secret():
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
@@ -27,11 +63,22 @@ def db_connect():
     asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
         asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        return json.loads(asm_response['SecretString'])
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
+
+rds_secret_cache = SecretCache(get_rds_secret,
+    ttl=int(getSetting('secret_ttl', fallback='300')))
+
+
+"""Get connection to the reference database on RDS
+Credentials come from the cached secret (see secret_ttl).
+"""
+def mysql_connect():
+    rds_secret = rds_secret_cache.get()
+
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -48,6 +95,28 @@ def db_connect():
         db=database_name)
 
 
+"""Ping a pooled connection, reconnecting if the server dropped it
+"""
+def mysql_check(conn):
+    conn.ping(reconnect=True)
+
+
+mysql_connection_pool = None
+
+"""Process-wide pool of warm RDS connections (see db_pool_size)
+A connection that fails its health check is replaced, and the secret
+refetched in case it was rotated.
+"""
+def mysql_pool():
+    global mysql_connection_pool
+    if mysql_connection_pool is None:
+        mysql_connection_pool = ConnectionPool(mysql_connect,
+            check=mysql_check,
+            size=int(getSetting('db_pool_size', fallback='4')),
+            onFailure=rds_secret_cache.invalidate)
+    return mysql_connection_pool
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
@@ -0,0 +1,19 @@
+#!/bin/bash
+
+# package_annotator.sh
+#
+# Builds gas_annotator.zip, the bundle annotator instances unzip into
+# gas/ann at launch (see aws/user_data_annotator.txt), and uploads it.
+# The SQS consumer lives in util/ and is shared with the utility daemons,
+# so it is copied into the bundle next to annotator.py.
+
+cd "$(dirname "$0")"
+BUNDLE=$(mktemp -d)
+
+cp -r . $BUNDLE
+cp ../util/consumer.py $BUNDLE/consumer.py
+rm -rf $BUNDLE/gas_annotator.zip $(find $BUNDLE -name __pycache__)
+
+(cd $BUNDLE && zip -qr gas_annotator.zip .)
+aws s3 cp $BUNDLE/gas_annotator.zip s3://mpcs-cc-students/koyya/gas_annotator.zip
+rm -rf $BUNDLE
@@ -10,14 +10,15 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os
 import sys
 import boto3
-import json
 import time
-from datetime import datetime, timedelta
+import math
 from botocore.exceptions import ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
-import helpers
+from consumer import QueueConsumer, RetryLater
+from glacier_transfer import glacier_part_size
+from archive_backends import create_backends
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -33,6 +34,9 @@ sqs_queue_name = config['sqs1']['queue_name']
 dynamodb_table_name = config['dynamodb']['table_name']
 s3_bucket_name = config['s3']['bucket_name']
 glacier_vault_name = config['glacier']['vault_name']
+# Seconds after completion before a free user's results are archived
+archive_grace_seconds = config.getint('archive', 'GracePeriodSeconds',
+    fallback=300)
 
 # AWS clients
 sqs = boto3.client('sqs', region_name=region)
@@ -41,65 +45,129 @@ s3 = boto3.client('s3', region_name=region)
 glacier = boto3.client('glacier', region_name=region)
 queue_url = config['sqs']['QueueUrl']
 
+# Where results are archived: glacier (vault), s3 (archive storage class,
+# in place) or local (directory; for tests and benchmarks)
+backends = create_backends(config, s3, glacier, glacier_vault_name,
+    # Results are compressed on their way to Glacier: zstd if the zstandard
+    # package is installed, otherwise gzip
+    codec=config.get('compression', 'Codec', fallback='zstd'),
+    part_size=glacier_part_size(
+        config.getint('glacier', 'PartSizeMB', fallback=8)),
+    # Results up to PackMaxFileBytes are packed together, in archives of up
+    # to PackMaxFiles files or PackMaxBytes bytes, collected for at most
+    # PackWindowSeconds; 0 archives every result on its own
+    pack_max_file_bytes=config.getint('pack', 'PackMaxFileBytes',
+        fallback=1024 * 1024),
+    pack={
+        'window': config.getint('pack', 'PackWindowSeconds', fallback=60),
+        'max_files': config.getint('pack', 'PackMaxFiles', fallback=50),
+        'max_bytes': config.getint('pack', 'PackMaxBytes',
+            fallback=64 * 1024 * 1024)
+    },
+    # Larger results streamed to Glacier at once
+    max_streaming=config.getint('glacier', 'MaxStreaming', fallback=4),
+    # Tracks the jobs in each packed archive, so it can be deleted once
+    # they are all restored
+    pack_table=dynamo.Table(config['pack']['Table'])
+        if config.has_option('pack', 'Table') else None)
+backend = backends[config.get('backend', 'Type', fallback='glacier')]
+
+"""Whether an AWS error may clear up if the request is tried again
+"""
+def transient_error(e):
+    code = e.response.get('Error', {}).get('Code', '')
+    status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    return (status >= 500) or ('Throttl' in code) or \
+        (code in ('RequestTimeout', 'RequestLimitExceeded',
+            'ProvisionedThroughputExceededException', 'SlowDown'))
+
+
+def is_archived(table, job_id):
+    response = table.get_item(Key={'job_id': job_id}, ConsistentRead=True,
+        ProjectionExpression='results_file_archive_id')
+    return 'results_file_archive_id' in response.get('Item', {})
+
+
+"""Archive a job's results; True when the message is done with
+A job already archived (the message was redelivered after archiving
+went through) is not archived again. Only errors that may clear up
+leave the message to be retried; others are logged and the message
+dropped, as there is nothing a retry could do about them.
+"""
 def archive_to_glacier(s3_bucket, s3_key, job_id):
+    table = dynamo.Table(dynamodb_table_name)
     try:
-        # Download the S3 object
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
-        s3_object = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-        s3_data = s3_object['Body'].read()
-
-        # Upload to Glacier
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/upload_archive.html
-        response = glacier.upload_archive(vaultName=glacier_vault_name, body=s3_data)
-        archive_id = response['archiveId']
+        if is_archived(table, job_id):
+            print(f"Job {job_id} is already archived.")
+            # Finish what a previous attempt may have left undone
+            backend.archived(s3_bucket, s3_key)
+            return True
+        attributes = backend.archive(job_id, s3_bucket, s3_key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404') \
+            and is_archived(table, job_id):
+            # Archived by an earlier attempt in the meantime
+            return True
+        print(f"Failed to archive job {job_id}: {e}")
+        return not transient_error(e)
 
-        # Update DynamoDB with the Glacier archive ID
+    try:
+        # Update DynamoDB with the archive ID, the backend, and whatever else
+        # the backend needs to restore the results (codec, offsets)
         # https://stackoverflow.com/questions/55256127/update-item-in-dynamodb
-        table = dynamo.Table(dynamodb_table_name)
+        recorded = dict(attributes, archive_backend=backend.name)
+        update = 'SET ' + ', '.join(f"{name} = :{name}"
+            for name in recorded)
+        values = {f":{name}": value for (name, value) in recorded.items()}
         table.update_item(
             Key={'job_id': job_id},
-            UpdateExpression='SET results_file_archive_id = :archive_id',
-            ExpressionAttributeValues={':archive_id': archive_id}
+            UpdateExpression=update,
+            ExpressionAttributeValues=values
         )
+    except ClientError as e:
+        print(f"Failed to record archive of job {job_id}: {e}")
+        # Nothing refers to the archive; drop it before the retry
+        backend.discard(job_id, attributes)
+        return False
 
-        # Delete the S3 object after archiving
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_object.html
-        s3.delete_object(Bucket=s3_bucket, Key=s3_key)
-
-        print(f"Successfully archived job {job_id} to Glacier.")
+    try:
+        # Drop the S3 object if the backend copied it elsewhere
+        backend.archived(s3_bucket, s3_key)
     except ClientError as e:
-        print(f"Failed to archive job {job_id}: {e}")
+        # The job is archived all the same; a redelivered message would
+        # only try the delete again
+        print(f"Failed to delete archived results of job {job_id}: {e}")
+
+    print(f"Successfully archived job {job_id} to {backend.name}.")
+    return True
+
+
+"""Archive a free user's results once their grace period has passed
+The due time comes from the completion time in the message itself, so
+nothing is kept per job and a restart loses nothing. A message that
+arrives early is handed back to SQS hidden for exactly the time left,
+so it comes back when it is due without holding a handler meanwhile.
+"""
+def handle_archive_message(message_data, message):
+    job_id = message_data['job_id']
+    s3_key = message_data['s3_key']
+    due = message_data['completion_time'] + archive_grace_seconds
+    remaining = due - time.time()
+    if remaining > 0:
+        # Not due yet; SQS allows at most 12 hours of invisibility
+        raise RetryLater(min(math.ceil(remaining), 12 * 60 * 60))
+    # Delete the message from the queue once archived; otherwise it is
+    # redelivered and archiving is tried again
+    return archive_to_glacier(s3_bucket_name, s3_key, job_id)
 
 
 def process_messages():
-    first_completion_time = {}
-    while True:
-        # Receive a message from SQS
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=10,
-            WaitTimeSeconds=20
-        )
-
-        messages = response.get('Messages', [])
-        for message in messages:
-            try:
-                body = json.loads(message['Body'])
-                message_data = json.loads(body['Message'])
-                job_id = message_data['job_id']
-                s3_key = message_data['s3_key']
-                completion_time = datetime.fromtimestamp(message_data['completion_time'])
-                # Check if the completion time for this job has been recorded before
-                if job_id not in first_completion_time:
-                    first_completion_time[job_id] = completion_time  # Record the first completion time
-                if first_completion_time and (datetime.utcnow() - first_completion_time[job_id]) > timedelta(minutes=5):
-                    archive_to_glacier(s3_bucket_name, s3_key, job_id)
-                    # Delete the message from the queue after processing
-                    sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
-                else:
-                    time.sleep(60)
-            except Exception as e:
-                print(f"Failed to process message: {e}")
+    backend.start()
+    consumer = QueueConsumer(sqs, queue_url, handle_archive_message,
+        concurrency=config.getint('consumer', 'Concurrency', fallback=64),
+        visibility_timeout=config.getint('consumer', 'VisibilityTimeout',
+            fallback=300))
+    consumer.run()
 
 if __name__ == '__main__':
     process_messages()
@@ -0,0 +1,569 @@
+# archive_backends.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Where free user results are archived: a Glacier vault, an S3 archive
+# storage class, or a local directory
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import time
+import uuid
+import threading
+from botocore.exceptions import ClientError
+
+from glacier_transfer import (MB, upload_stream_to_glacier, pack_archive,
+    aligned_range, copy_job_output_to_s3, upload_stream_to_s3, tree_hash,
+    TreeHashingReader)
+from compression import (available_codec, CodecReader, compress_bytes,
+    decompress_bytes)
+
+
+"""Results compressed on archiving are put back in S3 gzipped, with
+Content-Encoding: gzip, so downloads stay compressed and browsers
+decompress them; zstd results are recompressed as gzip on the way
+"""
+def restored_encoding(codec):
+    return {'ContentEncoding': 'gzip'} if codec else {}
+
+
+"""What archive.py, restore.py and thaw.py need from an archive
+
+archive.py calls archive() for a due results object and records the
+attributes it returns on the job item (with archive_backend set to the
+backend's name), then calls archived() to drop the object if the
+backend copied it elsewhere. restore.py calls restore() with the job's
+location: those attributes plus job_id and file_name (see
+archive_location.py), and passes the ticket it returns on to
+thaw.py. thaw.py waits for completed() to report the ticket, then calls
+finish() to put the results back in S3. CLEARED lists the attributes
+removed from the job item once that is done.
+"""
+class ArchiveBackend(object):
+    name = None
+    CLEARED = ['results_file_archive_id', 'results_file_codec']
+
+    def start(self):
+        pass
+
+    """Archive s3://bucket/key; returns the attributes for the job item,
+    including results_file_archive_id
+    """
+    def archive(self, job_id, bucket, key):
+        raise NotImplementedError
+
+    def archived(self, bucket, key):
+        pass
+
+    """Start bringing back archived results; returns a ticket
+    """
+    def restore(self, location):
+        raise NotImplementedError
+
+    """Of tickets, those whose restores have completed, mapped to
+    'Succeeded' or 'Failed'
+    """
+    def completed(self, tickets):
+        raise NotImplementedError
+
+    """Put the restored results at s3://bucket/key
+    """
+    def finish(self, location, ticket, bucket, key):
+        raise NotImplementedError
+
+    """Undo archive() for results whose attributes could not be recorded,
+    so the retried message archives them afresh
+    """
+    def discard(self, job_id, attributes):
+        pass
+
+
+"""Packs small results from concurrent handlers into shared archives
+
+Each add() joins the pack being collected and blocks until that pack is
+archived by upload(body, description), then returns where its file
+ended up: (archive_id, offset, length, archive_size). A pack is written
+once it holds max_files files or max_bytes bytes, or window seconds
+after its first file arrived, with one upload for the lot, and then
+packed(archive_id, job_ids), if given, is called. If either fails,
+every add() in the pack raises; archive.py lets the error reach the
+queue consumer, so all their messages are retried.
+"""
+class ArchivePacker(object):
+    def __init__(self, upload, window=60, max_files=50,
+        max_bytes=64 * 1024 * 1024, packed=None):
+
+        self.upload = upload
+        self.packed = packed
+        self.window = window
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.pending = []
+        self.pending_bytes = 0
+        self.opened = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def full(self):
+        return (len(self.pending) >= self.max_files) or \
+            (self.pending_bytes >= self.max_bytes)
+
+    def add(self, job_id, data):
+        entry = {'job_id': job_id, 'data': data, 'done': threading.Event(),
+            'result': None, 'error': None}
+        with self.cond:
+            if not self.pending:
+                self.opened = time.time()
+            self.pending.append(entry)
+            self.pending_bytes += len(data)
+            self.cond.notify()
+
+        entry['done'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending or not (self.full() or
+                    time.time() >= self.opened + self.window):
+                    self.cond.wait((self.opened + self.window - time.time())
+                        if self.pending else None)
+                batch = self.pending[0:self.max_files]
+                self.pending = self.pending[self.max_files:]
+                self.pending_bytes = sum(len(e['data']) for e in self.pending)
+                self.opened = time.time()
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            (body, offsets) = pack_archive(
+                [(entry['job_id'], entry['data']) for entry in batch])
+            archive_id = self.upload(body,
+                f"Packed results of {len(batch)} jobs")
+            if self.packed is not None:
+                self.packed(archive_id, [entry['job_id'] for entry in batch])
+            print(f"Packed {len(batch)} results into archive {archive_id}")
+            for (entry, (offset, length)) in zip(batch, offsets):
+                entry['result'] = (archive_id, offset, length, len(body))
+        except Exception as e:
+            for entry in batch:
+                entry['error'] = e
+        finally:
+            for entry in batch:
+                entry['done'].set()
+
+
+"""Archives in a Glacier vault (the legacy vault API)
+
+Results are compressed with codec and streamed into the vault a
+part_size part at a time; results of up to pack_max_file_bytes are
+packed together by an ArchivePacker (pack options are passed to it)
+and restored with a megabyte-aligned ranged retrieval. Restores are
+Glacier retrieval jobs; their output is copied back to S3 in parallel
+verified ranges (transfer_*), or recompressed as one stream for zstd.
+
+A packed archive is deleted once none of its jobs need it. pack_table
+(a table of its own, keyed by archive_id) holds an item for each packed
+archive with the set of jobs still archived in it. Each job leaves the set when its results are restored (or were
+never recorded), and whoever empties it deletes the archive. Removing a
+member from a set is idempotent, so retried messages can't release an
+archive early. Without pack_table, packed archives are kept.
+"""
+class GlacierVaultBackend(ArchiveBackend):
+    name = 'glacier'
+    CLEARED = ArchiveBackend.CLEARED + ['archive_offset', 'archive_length',
+        'archive_size']
+
+    def __init__(self, glacier, s3, vault_name, codec='zstd',
+        part_size=8 * MB, pack_max_file_bytes=MB, max_streaming=4,
+        pack=None, transfer_part_size=16 * MB, transfer_concurrency=4,
+        transfer_slots=None, pack_table=None):
+
+        self.glacier = glacier
+        self.s3 = s3
+        self.vault_name = vault_name
+        self.codec = available_codec(codec)
+        self.part_size = part_size
+        self.pack_max_file_bytes = pack_max_file_bytes
+        self.streaming_slots = threading.BoundedSemaphore(max_streaming)
+        self.pack_table = pack_table
+        self.packer = ArchivePacker(self.upload, packed=self.record_pack,
+            **(pack or {}))
+        self.transfer_part_size = transfer_part_size
+        self.transfer_concurrency = transfer_concurrency
+        self.transfer_slots = transfer_slots or \
+            threading.BoundedSemaphore(transfer_concurrency)
+
+    def start(self):
+        self.packer.start()
+
+    def upload(self, body, description=None):
+        return upload_stream_to_glacier(self.glacier, self.vault_name,
+            io.BytesIO(body), part_size=self.part_size,
+            description=description)
+
+    def pack_key(self, archive_id):
+        return {'archive_id': archive_id}
+
+    def record_pack(self, archive_id, job_ids):
+        if self.pack_table is None:
+            return
+        try:
+            self.pack_table.put_item(Item=dict(self.pack_key(archive_id),
+                members=set(job_ids)))
+        except Exception:
+            # Nothing would ever release the archive; the jobs pack again
+            self.delete_archive(archive_id)
+            raise
+
+    """Take job_id out of a packed archive's members, deleting the archive
+    with the last of them
+    """
+    def release_pack(self, archive_id, job_id):
+        if self.pack_table is None:
+            return
+        try:
+            # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html#Expressions.UpdateExpressions.DELETE
+            response = self.pack_table.update_item(
+                Key=self.pack_key(archive_id),
+                UpdateExpression='DELETE members :job',
+                ConditionExpression='attribute_exists(archive_id)',
+                ExpressionAttributeValues={':job': {job_id}},
+                ReturnValues='ALL_NEW')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # Packed before members were tracked, or already deleted; keep it
+            return
+        if response['Attributes'].get('members'):
+            return
+        self.delete_archive(archive_id)
+        self.pack_table.delete_item(Key=self.pack_key(archive_id))
+        print(f"Deleted packed archive {archive_id}; all its jobs are restored")
+
+    def delete_archive(self, archive_id):
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/delete_archive.html
+        try:
+            self.glacier.delete_archive(vaultName=self.vault_name,
+                archiveId=archive_id)
+        except self.glacier.exceptions.ResourceNotFoundException:
+            pass
+
+    def archive(self, job_id, bucket, key):
+        # Stream the S3 object into Glacier a part at a time, compressing it
+        # on the way, so memory use does not grow with the size of the
+        # results file; small results share a packed archive, located by
+        # their offset and length
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+        # https://docs.aws.amazon.com/amazonglacier/latest/dev/uploading-archive-mpu.html
+        s3_object = self.s3.get_object(Bucket=bucket, Key=key)
+        # Compressed as it is read, unless it already is
+        codec = s3_object.get('ContentEncoding') or self.codec
+        body = s3_object['Body'] if s3_object.get('ContentEncoding') \
+            else CodecReader(s3_object['Body'], codec)
+        attributes = {'results_file_codec': codec}
+        try:
+            if s3_object['ContentLength'] <= self.pack_max_file_bytes:
+                (archive_id, offset, length, archive_size) = self.packer.add(
+                    job_id, body.read())
+                attributes.update({'archive_offset': offset,
+                    'archive_length': length, 'archive_size': archive_size})
+            else:
+                with self.streaming_slots:
+                    archive_id = upload_stream_to_glacier(self.glacier,
+                        self.vault_name, body, part_size=self.part_size)
+        finally:
+            body.close()
+        attributes['results_file_archive_id'] = archive_id
+        return attributes
+
+    def archived(self, bucket, key):
+        # Delete the S3 object after archiving
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_object.html
+        self.s3.delete_object(Bucket=bucket, Key=key)
+
+    def restore(self, location):
+        job_parameters = {
+            'Type': 'archive-retrieval',
+            'ArchiveId': location['archive_id']
+        }
+        if 'archive_offset' in location:
+            (first, last) = aligned_range(location['archive_offset'],
+                location['archive_length'], location['archive_size'])
+            job_parameters['RetrievalByteRange'] = f"{first}-{last}"
+        try:
+            # Attempt expedited retrieval first
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_job.html
+            response = self.glacier.initiate_job(vaultName=self.vault_name,
+                jobParameters=dict(job_parameters, Tier='Expedited'))
+        # https://botocore.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/exceptions/InsufficientCapacityException.html
+        except self.glacier.exceptions.InsufficientCapacityException:
+            # Fallback to standard retrieval
+            response = self.glacier.initiate_job(vaultName=self.vault_name,
+                jobParameters=dict(job_parameters, Tier='Standard'))
+        return response['jobId']
+
+    def completed(self, tickets):
+        # One sweep over the vault's completed jobs, a page at a time
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/list_jobs.html
+        statuses = {}
+        marker = None
+        while True:
+            kwargs = {'vaultName': self.vault_name, 'completed': 'true'}
+            if marker:
+                kwargs['marker'] = marker
+            response = self.glacier.list_jobs(**kwargs)
+            for job in response.get('JobList', []):
+                if job['JobId'] in tickets:
+                    statuses[job['JobId']] = job['StatusCode']
+            marker = response.get('Marker')
+            if not marker:
+                return statuses
+
+    def finish(self, location, ticket, bucket, key):
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/describe_job.html
+        job = self.glacier.describe_job(vaultName=self.vault_name,
+            jobId=ticket)
+        # Codec the results were compressed with, if any
+        codec = location.get('codec')
+        if 'archive_offset' in location:
+            # Packed with other results; cut this job's bytes out of the range
+            self.copy_packed_result(job, ticket, bucket, key,
+                location['archive_offset'], location['archive_length'], codec)
+            # The archive goes once every job packed in it is restored
+            self.release_pack(location['archive_id'], location['job_id'])
+            return
+
+        if codec == 'zstd':
+            self.copy_zstd_output(job, ticket, bucket, key)
+        else:
+            # Move the object to S3, in parallel ranges checked against the
+            # archive's tree hash
+            copy_job_output_to_s3(self.glacier, self.vault_name, ticket,
+                self.s3, bucket, key, int(job['ArchiveSizeInBytes']),
+                expected_tree_hash=job.get('SHA256TreeHash'),
+                part_size=self.transfer_part_size,
+                concurrency=self.transfer_concurrency,
+                slots=self.transfer_slots, **restored_encoding(codec))
+
+        # Delete the archive from Glacier
+        self.delete_archive(location['archive_id'])
+
+    def discard(self, job_id, attributes):
+        archive_id = attributes['results_file_archive_id']
+        if 'archive_offset' in attributes:
+            self.release_pack(archive_id, job_id)
+        else:
+            self.delete_archive(archive_id)
+
+    """Copy one job's results out of a ranged retrieval of a packed archive
+    The job output starts at the start of the job's RetrievalByteRange;
+    it is checked against the job's tree hash when Glacier gives one
+    (only tree-hash aligned ranges have one).
+    """
+    def copy_packed_result(self, job, ticket, bucket, key, offset, length,
+        codec):
+        first = int(job['RetrievalByteRange'].split('-')[0])
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
+        job_output = self.glacier.get_job_output(vaultName=self.vault_name,
+            jobId=ticket)
+        restored_data = job_output['body'].read()
+        if job.get('SHA256TreeHash') and \
+            tree_hash(restored_data) != job['SHA256TreeHash']:
+            raise IOError(f"Tree hash mismatch for Glacier job {ticket}")
+        restored_data = restored_data[offset - first:offset - first + length]
+        if codec == 'zstd':
+            restored_data = compress_bytes(
+                decompress_bytes(restored_data, codec), 'gzip')
+        self.s3.put_object(Bucket=bucket, Key=key, Body=restored_data,
+            **restored_encoding(codec))
+
+    """Copy a zstd-compressed archive into S3 as gzip
+    Decompression has to go in order, so the job output is read as one
+    stream, recompressed as it goes and uploaded a part at a time; its
+    tree hash is checked before the upload is completed.
+    """
+    def copy_zstd_output(self, job, ticket, bucket, key):
+        job_output = self.glacier.get_job_output(vaultName=self.vault_name,
+            jobId=ticket)
+        restored = TreeHashingReader(job_output['body'])
+
+        def verify():
+            if job.get('SHA256TreeHash') and \
+                restored.hasher.hexdigest() != job['SHA256TreeHash']:
+                raise IOError(f"Tree hash mismatch for Glacier job {ticket}")
+
+        body = CodecReader(CodecReader(restored, 'zstd', decompress=True),
+            'gzip')
+        try:
+            upload_stream_to_s3(self.s3, bucket, key, body,
+                part_size=self.transfer_part_size, verify=verify,
+                **restored_encoding('zstd'))
+        finally:
+            restored.close()
+
+
+"""Archives results where they are, by moving them to an S3 archive
+storage class (GLACIER or DEEP_ARCHIVE)
+
+archive() is a server-side copy of the object onto itself in
+storage_class, and finish() one back to STANDARD after restore_object
+has made a temporary copy readable, so no results data passes through
+this instance. The archive ID is "bucket/key". Restores use tier,
+falling back from Expedited to Standard where S3 refuses it (always, for
+DEEP_ARCHIVE); completion is read from each object's Restore header.
+"""
+class S3StorageClassBackend(ArchiveBackend):
+    name = 's3'
+
+    def __init__(self, s3, storage_class='DEEP_ARCHIVE', restore_days=1,
+        tier='Standard'):
+
+        self.s3 = s3
+        self.storage_class = storage_class
+        self.restore_days = restore_days
+        self.tier = tier
+
+    def copy_in_place(self, bucket, key, storage_class):
+        # Managed copy: server side, multipart for objects over 5 GB
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html
+        self.s3.copy({'Bucket': bucket, 'Key': key}, bucket, key,
+            ExtraArgs={'StorageClass': storage_class,
+                'MetadataDirective': 'COPY'})
+
+    def archive(self, job_id, bucket, key):
+        self.copy_in_place(bucket, key, self.storage_class)
+        return {'results_file_archive_id': f"{bucket}/{key}"}
+
+    def restore(self, location):
+        (bucket, key) = location['archive_id'].split('/', 1)
+        tier = self.tier
+        while True:
+            try:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/restore_object.html
+                self.s3.restore_object(Bucket=bucket, Key=key,
+                    RestoreRequest={'Days': self.restore_days,
+                        'GlacierJobParameters': {'Tier': tier}})
+                return location['archive_id']
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'RestoreAlreadyInProgress':
+                    return location['archive_id']
+                if tier == 'Expedited' and code in ('InvalidArgument',
+                    'GlacierExpeditedRetrievalNotAvailable'):
+                    tier = 'Standard'
+                    continue
+                raise
+
+    def completed(self, tickets):
+        statuses = {}
+        for ticket in tickets:
+            (bucket, key) = ticket.split('/', 1)
+            try:
+                head = self.s3.head_object(Bucket=bucket, Key=key)
+            except ClientError as e:
+                print(f"Failed to check restore of {ticket}: {e}")
+                statuses[ticket] = 'Failed'
+                continue
+            restore = head.get('Restore')
+            if head.get('StorageClass') in (None, 'STANDARD') or \
+                (restore and 'ongoing-request="false"' in restore):
+                statuses[ticket] = 'Succeeded'
+        return statuses
+
+    def finish(self, location, ticket, bucket, key):
+        (archive_bucket, archive_key) = ticket.split('/', 1)
+        if (archive_bucket, archive_key) == (bucket, key):
+            self.copy_in_place(bucket, key, 'STANDARD')
+        else:
+            self.s3.copy({'Bucket': archive_bucket, 'Key': archive_key},
+                bucket, key, ExtraArgs={'StorageClass': 'STANDARD'})
+            self.s3.delete_object(Bucket=archive_bucket, Key=archive_key)
+
+
+"""Archives results as files in a local directory, for tests and
+benchmarks; restores complete at once
+"""
+class LocalBackend(ArchiveBackend):
+    name = 'local'
+
+    def __init__(self, s3, directory, codec='zstd'):
+        self.s3 = s3
+        self.directory = directory
+        self.codec = available_codec(codec)
+
+    def path(self, archive_id):
+        return os.path.join(self.directory, archive_id)
+
+    def archive(self, job_id, bucket, key):
+        os.makedirs(self.directory, exist_ok=True)
+        archive_id = str(uuid.uuid4())
+        s3_object = self.s3.get_object(Bucket=bucket, Key=key)
+        codec = s3_object.get('ContentEncoding') or self.codec
+        body = s3_object['Body'] if s3_object.get('ContentEncoding') \
+            else CodecReader(s3_object['Body'], codec)
+        try:
+            with open(self.path(archive_id), 'wb') as archive_file:
+                while True:
+                    data = body.read(MB)
+                    if not data:
+                        break
+                    archive_file.write(data)
+        finally:
+            body.close()
+        return {'results_file_archive_id': archive_id,
+            'results_file_codec': codec}
+
+    def archived(self, bucket, key):
+        self.s3.delete_object(Bucket=bucket, Key=key)
+
+    def discard(self, job_id, attributes):
+        os.remove(self.path(attributes['results_file_archive_id']))
+
+    def restore(self, location):
+        return location['archive_id']
+
+    def completed(self, tickets):
+        return {ticket: ('Succeeded' if os.path.exists(self.path(ticket))
+            else 'Failed') for ticket in tickets}
+
+    def finish(self, location, ticket, bucket, key):
+        codec = location.get('codec')
+        with open(self.path(ticket), 'rb') as archive_file:
+            body = archive_file
+            if codec == 'zstd':
+                body = CodecReader(CodecReader(archive_file, codec,
+                    decompress=True), 'gzip')
+            upload_stream_to_s3(self.s3, bucket, key, body,
+                **restored_encoding(codec))
+        os.remove(self.path(ticket))
+
+
+"""Every backend, by name, set up from a utility's configuration
+glacier_options are passed to GlacierVaultBackend; the [s3class] and
+[local] sections configure the other two.
+"""
+def create_backends(config, s3, glacier, vault_name, **glacier_options):
+    return {
+        'glacier': GlacierVaultBackend(glacier, s3, vault_name,
+            **glacier_options),
+        's3': S3StorageClassBackend(s3,
+            storage_class=config.get('s3class', 'StorageClass',
+                fallback='DEEP_ARCHIVE'),
+            restore_days=config.getint('s3class', 'RestoreDays', fallback=1),
+            tier=config.get('s3class', 'Tier', fallback='Standard')),
+        'local': LocalBackend(s3,
+            config.get('local', 'Directory', fallback='/tmp/gas-archive'),
+            codec=glacier_options.get('codec', 'zstd')),
+    }
+
+### EOF
@@ -0,0 +1,33 @@
+# archive_location.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Where a job's archived results are, as passed from the web app to
+# restore.py and on to thaw.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+
+"""Where a job's results are archived: the backend (glacier for items
+archived before there was a choice), archive_id, job_id and file_name,
+plus archive_offset, archive_length and archive_size for results packed
+with others into one archive, and the codec they were compressed with,
+from the job's item in the annotations table
+"""
+def archive_location(item):
+    location = {
+        'backend': item.get('archive_backend', 'glacier'),
+        'archive_id': item['results_file_archive_id'],
+        'job_id': item['job_id'],
+        'file_name': item.get('input_file_name')
+    }
+    for name in ('archive_offset', 'archive_length', 'archive_size'):
+        if name in item:
+            location[name] = int(item[name])
+    if 'results_file_codec' in item:
+        location['codec'] = item['results_file_codec']
+    return location
+
+### EOF
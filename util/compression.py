@@ -0,0 +1,93 @@
+# compression.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Streaming compression of archived results: zstd, or gzip without it
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import zlib
+
+# zstd needs the zstandard package; without it results are gzipped
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+
+
+"""codec if it can be used here, else gzip
+"""
+def available_codec(codec='zstd'):
+    if codec == 'zstd' and zstandard is None:
+        return 'gzip'
+    return codec
+
+
+def compressor(codec):
+    if codec == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompressor(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown codec {codec}")
+
+
+"""Stream with read(n) over another stream's bytes, compressed or
+decompressed as they are read
+body is read chunk_size bytes at a time, so only about a chunk is held
+in memory whatever the size of the stream.
+"""
+class CodecReader(object):
+    def __init__(self, body, codec, decompress=False, chunk_size=CHUNK_SIZE):
+        self.body = body
+        self.decompress = decompress
+        self.codec = decompressor(codec) if decompress else compressor(codec)
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.finished = False
+
+    def fill(self):
+        chunk = self.body.read(self.chunk_size)
+        if not chunk:
+            if not self.decompress:
+                self.buffer += self.codec.flush()
+            self.finished = True
+        elif self.decompress:
+            self.buffer += self.codec.decompress(chunk)
+        else:
+            self.buffer += self.codec.compress(chunk)
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            self.fill()
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[0:size])
+        del self.buffer[0:size]
+        return data
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+def compress_bytes(data, codec):
+    return CodecReader(io.BytesIO(data), codec).read()
+
+
+def decompress_bytes(data, codec):
+    return CodecReader(io.BytesIO(data), codec, decompress=True).read()
+
+### EOF
@@ -0,0 +1,355 @@
+# consumer.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# SQS consumer shared by the annotator and the utility daemons
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""Body of an SNS notification delivered through SQS, decoded from JSON
+"""
+def sns_message(message):
+    body = json.loads(message['Body'])
+    return json.loads(body['Message'])
+
+
+"""Raised by a handler to have its message redelivered after delay seconds
+The message is neither deleted nor counted as failed.
+"""
+class RetryLater(Exception):
+    def __init__(self, delay):
+        Exception.__init__(self, f"Retry in {delay}s")
+        self.delay = int(delay)
+
+
+"""Per-queue throughput and latency counters
+"""
+class ConsumerMetrics(object):
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.received = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.deleted = 0
+        self.extended = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def count(self, field, n=1):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def handled(self, outcome, latency):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            done = self.succeeded + self.failed + self.retried
+            return {
+                'queue': self.name,
+                'received': self.received,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'retried': self.retried,
+                'deleted': self.deleted,
+                'extended': self.extended,
+                'errors': self.errors,
+                'per_minute': round(60.0 * done / elapsed, 2),
+                'latency_avg': round(self.latency_total / done, 3) if done else 0.0,
+                'latency_max': round(self.latency_max, 3),
+            }
+
+
+"""Long-running SQS consumer
+
+Receives messages in batches of up to batch_size and runs handler(data,
+message) for each in a pool of concurrency threads, where data is the
+message decoded by decode (by default the SNS notification inside it).
+A handler that returns True has its message deleted; deletes are sent
+in batches with delete_message_batch. A handler that returns anything
+else, raises, or fails to decode leaves its message on the queue to be
+redelivered once its visibility timeout lapses, and RetryLater sets
+that timeout explicitly.
+
+No more messages are received than there are free handler slots (and,
+if given, than capacity() allows), so a slow message only ever holds up
+its own slot. While a handler runs, its message's visibility timeout is
+extended by visibility_timeout seconds every half timeout, so long
+handlers are not redelivered to another consumer mid-flight. Metrics
+are printed every report_every seconds.
+
+SQS errors (throttling, network failures, expired receipt handles) are
+logged and the loop carries on after a backoff that doubles with each
+consecutive failure up to max_backoff seconds; deletes that failed are
+tried again on the next pass.
+
+sqs is a boto3 SQS client or anything with the same methods, such as
+LocalQueue.
+"""
+class QueueConsumer(object):
+    def __init__(self, sqs, queue_url, handler, concurrency=1, batch_size=10,
+        wait_time=20, visibility_timeout=300, decode=sns_message,
+        capacity=None, name=None, report_every=300, max_backoff=60):
+
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.handler = handler
+        self.concurrency = concurrency
+        self.batch_size = min(batch_size, 10)
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.decode = decode
+        self.capacity = capacity
+        self.report_every = report_every
+        self.max_backoff = max_backoff
+        self.metrics = ConsumerMetrics(name or queue_url.split('/')[-1])
+
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.to_delete = []
+        self.stopped = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.last_report = time.time()
+
+    """Messages whose handlers are still running
+    """
+    def handling(self):
+        with self.lock:
+            return len(self.in_flight)
+
+    def free_slots(self):
+        with self.lock:
+            free = self.concurrency - len(self.in_flight)
+        if self.capacity is not None:
+            free = min(free, self.capacity())
+        return max(0, min(free, self.batch_size))
+
+    """Receive one batch (if there is room) and hand it to the handlers
+    Returns the number of messages received.
+    """
+    def poll_once(self, wait_time=None):
+        self.flush_deletes()
+        self.extend_visibility()
+        self.report()
+
+        free = self.free_slots()
+        if free == 0:
+            self.stopped.wait(1)
+            return 0
+
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=free,
+            WaitTimeSeconds=(self.wait_time if wait_time is None
+                else wait_time))
+        messages = response.get('Messages', [])
+        self.metrics.count('received', len(messages))
+
+        for message in messages:
+            receipt_handle = message['ReceiptHandle']
+            with self.lock:
+                self.in_flight[receipt_handle] = time.time()
+            self.executor.submit(self.handle, message)
+        return len(messages)
+
+    def handle(self, message):
+        receipt_handle = message['ReceiptHandle']
+        started = time.time()
+        outcome = 'failed'
+        try:
+            data = self.decode(message) if self.decode is not None else message
+            if self.handler(data, message) is True:
+                outcome = 'succeeded'
+        except RetryLater as retry:
+            outcome = 'retried'
+            try:
+                self.sqs.change_message_visibility(QueueUrl=self.queue_url,
+                    ReceiptHandle=receipt_handle, VisibilityTimeout=retry.delay)
+            except Exception as e:
+                # The message comes back when its current timeout lapses
+                print(f"Failed to delay message from {self.metrics.name}: {e}")
+        except Exception as e:
+            print(f"Failed to process message from {self.metrics.name}: {e}")
+        finally:
+            with self.lock:
+                del self.in_flight[receipt_handle]
+                if outcome == 'succeeded':
+                    self.to_delete.append(receipt_handle)
+            self.metrics.handled(outcome, time.time() - started)
+
+    """Delete handled messages, up to ten per request
+    """
+    def flush_deletes(self):
+        with self.lock:
+            handles = self.to_delete
+            self.to_delete = []
+
+        for i in range(0, len(handles), 10):
+            batch = handles[i:i + 10]
+            try:
+                response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{'Id': str(n), 'ReceiptHandle': handle}
+                        for (n, handle) in enumerate(batch)])
+            except Exception:
+                # Keep the rest for the next pass
+                with self.lock:
+                    self.to_delete.extend(handles[i:])
+                raise
+            self.metrics.count('deleted', len(response.get('Successful', [])))
+            for failure in response.get('Failed', []):
+                print(f"Failed to delete message from {self.metrics.name}: " +
+                    f"{failure.get('Message')}")
+
+    """Push back the visibility timeout of messages still being handled
+    """
+    def extend_visibility(self):
+        if not self.visibility_timeout:
+            return
+        now = time.time()
+        with self.lock:
+            due = [handle for (handle, since) in self.in_flight.items()
+                if now - since >= self.visibility_timeout / 2]
+
+        for i in range(0, len(due), 10):
+            batch = due[i:i + 10]
+            self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url,
+                Entries=[{'Id': str(n), 'ReceiptHandle': handle,
+                    'VisibilityTimeout': self.visibility_timeout}
+                    for (n, handle) in enumerate(batch)])
+            # Only extended messages wait another half timeout; a failed
+            # batch is tried again on the next pass
+            with self.lock:
+                for handle in batch:
+                    if handle in self.in_flight:
+                        self.in_flight[handle] = now
+            self.metrics.count('extended', len(batch))
+
+    def report(self, force=False):
+        if force or (time.time() - self.last_report >= self.report_every):
+            self.last_report = time.time()
+            print(f"Queue metrics: {json.dumps(self.metrics.snapshot())}")
+
+    """Consume until stop() is called
+    """
+    def run(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                self.poll_once()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                self.metrics.count('errors')
+                delay = min(self.max_backoff, 2 ** (failures - 1))
+                print(f"Error consuming from {self.metrics.name}: {e}; " +
+                    f"retrying in {delay}s")
+                self.stopped.wait(delay)
+
+    """Wait for running handlers, then send any outstanding deletes
+    """
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=True)
+        self.flush_deletes()
+        self.report(force=True)
+
+
+"""In-memory stand-in for an SQS queue
+Implements the client methods QueueConsumer uses (plus send_message)
+with SQS visibility semantics, for running a consumer without AWS.
+"""
+class LocalQueue(object):
+    def __init__(self, visibility_timeout=30):
+        self.visibility_timeout = visibility_timeout
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.visible_at = {}
+        self.receipts = {}
+        self.next_id = 0
+
+    def send_message(self, QueueUrl=None, MessageBody=None, DelaySeconds=0):
+        with self.lock:
+            self.next_id += 1
+            message_id = str(self.next_id)
+            self.messages[message_id] = MessageBody
+            self.visible_at[message_id] = time.time() + DelaySeconds
+        return {'MessageId': message_id}
+
+    """Queue an SNS notification the way an SNS-to-SQS subscription does
+    """
+    def publish(self, message):
+        return self.send_message(MessageBody=json.dumps(
+            {'Type': 'Notification', 'Message': json.dumps(message)}))
+
+    def receive_message(self, QueueUrl=None, MaxNumberOfMessages=1,
+        WaitTimeSeconds=0, **kwargs):
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            with self.lock:
+                now = time.time()
+                ready = sorted((m for (m, at) in self.visible_at.items()
+                    if at <= now), key=int)[0:MaxNumberOfMessages]
+                messages = []
+                for message_id in ready:
+                    self.next_id += 1
+                    receipt_handle = f"{message_id}-{self.next_id}"
+                    self.receipts[receipt_handle] = message_id
+                    self.visible_at[message_id] = now + self.visibility_timeout
+                    messages.append({'MessageId': message_id,
+                        'ReceiptHandle': receipt_handle,
+                        'Body': self.messages[message_id]})
+            if messages or (time.time() >= deadline):
+                return {'Messages': messages} if messages else {}
+            time.sleep(0.05)
+
+    def delete_message(self, QueueUrl=None, ReceiptHandle=None):
+        with self.lock:
+            message_id = self.receipts.pop(ReceiptHandle, None)
+            self.messages.pop(message_id, None)
+            self.visible_at.pop(message_id, None)
+        return {}
+
+    def delete_message_batch(self, QueueUrl=None, Entries=()):
+        for entry in Entries:
+            self.delete_message(ReceiptHandle=entry['ReceiptHandle'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries],
+            'Failed': []}
+
+    def change_message_visibility(self, QueueUrl=None, ReceiptHandle=None,
+        VisibilityTimeout=0):
+        with self.lock:
+            message_id = self.receipts.get(ReceiptHandle)
+            if message_id in self.visible_at:
+                self.visible_at[message_id] = time.time() + VisibilityTimeout
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl=None, Entries=()):
+        for entry in Entries:
+            self.change_message_visibility(
+                ReceiptHandle=entry['ReceiptHandle'],
+                VisibilityTimeout=entry['VisibilityTimeout'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries],
+            'Failed': []}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages)
+
+### EOF
@@ -0,0 +1,330 @@
+# glacier_transfer.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Streaming transfers into and out of Glacier, and SHA-256 tree hashing
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import json
+import struct
+import hashlib
+import binascii
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+# Last bytes of a packed archive (see pack_archive)
+PACK_MAGIC = b'GASPACK1'
+
+
+"""Incremental SHA-256 tree hash, as Glacier computes it for checksums
+Data is hashed in 1 MB leaves as it is fed in; completed subtrees are
+combined at once, so only O(log n) hashes are held however much data
+passes through.
+"""
+class TreeHash(object):
+    def __init__(self):
+        self.stack = []
+        self.leaf = hashlib.sha256()
+        self.leaf_size = 0
+        self.size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = min(MB - self.leaf_size, len(view))
+            self.leaf.update(view[:take])
+            self.leaf_size += take
+            self.size += take
+            view = view[take:]
+            if self.leaf_size == MB:
+                self.push_leaf()
+
+    def push_leaf(self):
+        # Each stack entry is (leaves covered, hash); equal neighbours merge
+        node = (1, self.leaf.digest())
+        while self.stack and self.stack[-1][0] == node[0]:
+            left = self.stack.pop()
+            node = (left[0] + node[0],
+                hashlib.sha256(left[1] + node[1]).digest())
+        self.stack.append(node)
+        self.leaf = hashlib.sha256()
+        self.leaf_size = 0
+
+    def digest(self):
+        hashes = [h for (leaves, h) in self.stack]
+        if self.leaf_size or not hashes:
+            hashes.append(self.leaf.digest())
+        # Left-over subtrees fold from the right, as Glacier's tree does
+        root = hashes.pop()
+        while hashes:
+            root = hashlib.sha256(hashes.pop() + root).digest()
+        return root
+
+    def hexdigest(self):
+        return binascii.hexlify(self.digest()).decode('ascii')
+
+
+def tree_hash(data):
+    hasher = TreeHash()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+"""Tree hash of a whole archive from the tree hashes (digests) of its
+consecutive parts, each 1 MB times a power of two except the last
+"""
+def combine_tree_hashes(hashes):
+    hashes = list(hashes)
+    while len(hashes) > 1:
+        hashes = [hashlib.sha256(hashes[i] + hashes[i + 1]).digest()
+            if i + 1 < len(hashes) else hashes[i]
+            for i in range(0, len(hashes), 2)]
+    return binascii.hexlify(hashes[0]).decode('ascii')
+
+
+"""Largest Glacier part size (1 MB times a power of two, up to 4 GB)
+not over part_size_mb megabytes
+"""
+def glacier_part_size(part_size_mb):
+    size = MB
+    while size * 2 <= min(part_size_mb, 4096) * MB:
+        size *= 2
+    return size
+
+
+"""Read up to size bytes from a stream such as an S3 GET body, which may
+return fewer bytes per read than asked for
+"""
+def read_part(body, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = body.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+"""Upload a stream to a Glacier vault part by part; returns the archive ID
+
+Only one part_size part of the stream is in memory at a time, and the
+archive's tree hash is computed as the parts go by. A stream that fits
+in a single part is sent with one upload_archive; anything larger goes
+through a multipart upload, which is aborted if any part fails.
+"""
+def upload_stream_to_glacier(glacier, vault_name, body, part_size=8 * MB,
+    description=None):
+
+    extra = {'archiveDescription': description} if description else {}
+    data = read_part(body, part_size)
+    following = read_part(body, part_size) if len(data) == part_size else b''
+    if not following:
+        response = glacier.upload_archive(vaultName=vault_name, body=data,
+            checksum=tree_hash(data), **extra)
+        return response['archiveId']
+
+    upload_id = glacier.initiate_multipart_upload(vaultName=vault_name,
+        partSize=str(part_size), **extra)['uploadId']
+    archive_hash = TreeHash()
+    try:
+        offset = 0
+        while data:
+            part_hash = tree_hash(data)
+            glacier.upload_multipart_part(vaultName=vault_name,
+                uploadId=upload_id,
+                range=f"bytes {offset}-{offset + len(data) - 1}/*",
+                body=data, checksum=part_hash)
+            archive_hash.update(data)
+            offset += len(data)
+            data = following
+            following = read_part(body, part_size) if data else b''
+
+        response = glacier.complete_multipart_upload(vaultName=vault_name,
+            uploadId=upload_id, archiveSize=str(offset),
+            checksum=archive_hash.hexdigest())
+        return response['archiveId']
+    except Exception:
+        glacier.abort_multipart_upload(vaultName=vault_name,
+            uploadId=upload_id)
+        raise
+
+
+"""Pack several small files into the body of one archive
+entries are (name, data) pairs. The files are laid out back to back
+from offset 0, followed by a JSON index of their names, offsets and
+lengths, the index's length (8 bytes, big-endian) and PACK_MAGIC, so a
+packed archive can be unpacked without anything stored elsewhere.
+Returns the body and the (offset, length) of each entry.
+"""
+def pack_archive(entries):
+    chunks = []
+    files = []
+    offset = 0
+    for (name, data) in entries:
+        chunks.append(data)
+        files.append({'name': name, 'offset': offset, 'length': len(data)})
+        offset += len(data)
+    index = json.dumps({'files': files}).encode('utf-8')
+    chunks.extend([index, struct.pack('>Q', len(index)), PACK_MAGIC])
+    return (b''.join(chunks),
+        [(f['offset'], f['length']) for f in files])
+
+
+"""The index pack_archive wrote at the end of a packed archive
+"""
+def read_pack_index(body):
+    if body[-len(PACK_MAGIC):] != PACK_MAGIC:
+        raise ValueError("Not a packed archive")
+    end = len(body) - len(PACK_MAGIC) - 8
+    (length,) = struct.unpack('>Q', body[end:end + 8])
+    return json.loads(body[end - length:end].decode('utf-8'))['files']
+
+
+"""Smallest megabyte-aligned byte range (first, last) of an archive of
+archive_size bytes that covers length bytes at offset, as Glacier
+requires of a ranged retrieval (RetrievalByteRange)
+"""
+def aligned_range(offset, length, archive_size):
+    first = (offset // MB) * MB
+    last = min(((offset + length + MB - 1) // MB) * MB, archive_size) - 1
+    return (first, last)
+
+
+"""Copy the output of a completed Glacier archive-retrieval job into S3
+
+The output is fetched as part_size byte ranges, concurrency at a time,
+and each range goes straight into the matching part of an S3 multipart
+upload, so at most concurrency parts are in memory (fewer if slots, a
+semaphore shared between transfers, runs out first). part_size is 1 MB
+times a power of two, so every range is tree-hash aligned: each is
+checked against the checksum Glacier returns for it, and the archive's
+tree hash, combined from the parts, against expected_tree_hash before
+the upload is completed. Output that fits in one part is copied with a
+single put_object. Any failure aborts the multipart upload. extra
+arguments (e.g. ContentEncoding) are passed on to S3 with the object.
+"""
+def copy_job_output_to_s3(glacier, vault_name, job_id, s3, bucket, key,
+    size, expected_tree_hash=None, part_size=8 * MB, concurrency=4,
+    slots=None, **extra):
+
+    slots = slots or threading.BoundedSemaphore(concurrency)
+    ranges = [(start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)] or [(0, -1)]
+
+    def fetch(first, last):
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
+        kwargs = {'vaultName': vault_name, 'jobId': job_id}
+        if size > part_size:
+            kwargs['range'] = f"bytes={first}-{last}"
+        response = glacier.get_job_output(**kwargs)
+        data = response['body'].read()
+        if len(data) != last - first + 1:
+            raise IOError(f"Glacier job {job_id} returned {len(data)} " +
+                f"bytes for bytes {first}-{last}")
+        hasher = TreeHash()
+        hasher.update(data)
+        if response.get('checksum') and \
+            response['checksum'] != hasher.hexdigest():
+            raise IOError(f"Tree hash mismatch in bytes {first}-{last} " +
+                f"of Glacier job {job_id}")
+        return (data, hasher.digest())
+
+    def verify(digests):
+        if expected_tree_hash and \
+            combine_tree_hashes(digests) != expected_tree_hash:
+            raise IOError(f"Tree hash mismatch for Glacier job {job_id}")
+
+    if len(ranges) == 1:
+        with slots:
+            (data, digest) = fetch(*ranges[0])
+            verify([digest])
+            s3.put_object(Bucket=bucket, Key=key, Body=data, **extra)
+        return
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key,
+        **extra)['UploadId']
+
+    def copy_part(number, first, last):
+        with slots:
+            (data, digest) = fetch(first, last)
+            response = s3.upload_part(Bucket=bucket, Key=key,
+                UploadId=upload_id, PartNumber=number, Body=data)
+        return (response['ETag'], digest)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(copy_part,
+                range(1, len(ranges) + 1),
+                [first for (first, last) in ranges],
+                [last for (first, last) in ranges]))
+        verify([digest for (etag, digest) in results])
+        s3.complete_multipart_upload(Bucket=bucket, Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n + 1, 'ETag': etag}
+                for (n, (etag, digest)) in enumerate(results)]})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+"""Upload a stream to S3 a part at a time, for streams (such as one being
+decompressed) that can only be read in order
+Only one part_size part is in memory at a time. verify, if given, is
+called once the stream is exhausted and before the upload is completed;
+raising there, like any other failure, aborts the multipart upload.
+extra arguments are passed on to S3 with the object.
+"""
+def upload_stream_to_s3(s3, bucket, key, body, part_size=8 * MB,
+    verify=None, **extra):
+
+    data = read_part(body, part_size)
+    following = read_part(body, part_size) if len(data) == part_size else b''
+    if not following:
+        if verify is not None:
+            verify()
+        s3.put_object(Bucket=bucket, Key=key, Body=data, **extra)
+        return
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key,
+        **extra)['UploadId']
+    try:
+        parts = []
+        while data:
+            response = s3.upload_part(Bucket=bucket, Key=key,
+                UploadId=upload_id, PartNumber=len(parts) + 1, Body=data)
+            parts.append({'PartNumber': len(parts) + 1,
+                'ETag': response['ETag']})
+            data = following
+            following = read_part(body, part_size) if data else b''
+        if verify is not None:
+            verify()
+        s3.complete_multipart_upload(Bucket=bucket, Key=key,
+            UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+"""Stream that tree-hashes the bytes read through it
+"""
+class TreeHashingReader(object):
+    def __init__(self, body):
+        self.body = body
+        self.hasher = TreeHash()
+
+    def read(self, size=-1):
+        data = self.body.read(size)
+        self.hasher.update(data)
+        return data
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+### EOF
@@ -41,38 +41,58 @@ def send_email_ses(recipients=None,
   return response
 
 
+import threading
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 
-"""Access user profile in accounts database
+# One connection pool per accounts database, made on first use, with a
+# semaphore of the pool's size: getconn() raises rather than waits when
+# every connection is out, so callers wait on the semaphore instead
+pools = {}
+pools_lock = threading.Lock()
+
+"""Pool of connections to the accounts database, and its semaphore
+The credentials are read from AWS Secrets Manager once, when the pool is
+made, rather than on every lookup.
 """
-def get_user_profile(id=None, db_name=None):
-  # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    raise ClientError
+def get_accounts_pool(db_name=None):
+  db_name = db_name or config['gas']['AccountsDatabase']
+  with pools_lock:
+    if db_name not in pools:
+      # Get database connection details from AWS Secrets Manager
+      asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
+      asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
+      rds_secret = json.loads(asm_response['SecretString'])
 
-  db_uri = "postgresql://" + rds_secret['username'] + ':' + \
-    rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
-    str(rds_secret['port']) + '/' + \
-    (db_name or config['gas']['AccountsDatabase'])
+      db_uri = "postgresql://" + rds_secret['username'] + ':' + \
+        rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
+        str(rds_secret['port']) + '/' + db_name
+      size = config.getint('gas', 'AccountsPoolSize', fallback=4)
+      pools[db_name] = (psycopg2.pool.ThreadedConnectionPool(1, size, db_uri),
+        threading.BoundedSemaphore(size))
+    return pools[db_name]
 
-  try:
-    # Connect to accounts database and get a cursor
-    connection = psycopg2.connect(db_uri)
-    cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
-    
-    # Query the database and get the user's profile record
-    query_string = f"SELECT * FROM profiles WHERE identity_id = '{id}'"
-    cursor.execute(query_string)
-    profile = cursor.fetchall()[0]
-  
-  except psycopg2.Error as e:
-    connection.rollback()
-    raise psycopg2.Error
+"""Access user profile in accounts database
+"""
+def get_user_profile(id=None, db_name=None):
+  (pool, slots) = get_accounts_pool(db_name)
+  with slots:
+    connection = pool.getconn()
+    broken = False
+    try:
+      # Query the database and get the user's profile record
+      cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
+      cursor.execute("SELECT * FROM profiles WHERE identity_id = %s", (id,))
+      profile = cursor.fetchall()[0]
+      connection.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+      # The connection may be dead; don't hand it out again
+      broken = True
+      raise
+    finally:
+      # The pool rolls back anything left open on connections it keeps
+      pool.putconn(connection, close=broken)
 
   # Return user profile record as a dict
   return profile
@@ -9,10 +9,13 @@ import sys
 import time
 import json
 import boto3
+from botocore.exceptions import ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
-import helpers
+from consumer import QueueConsumer
+from archive_backends import create_backends
+from archive_location import archive_location
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -28,88 +31,144 @@ sns_client = boto3.client('sns', region_name = region_name)
 queue_url = config.get('SQS','queueUrl')
 topic_arn_thaw = config.get('SNS','topic_arn_thaw')
 glacier_client = boto3.client('glacier', region_name = region_name)
+s3_client = boto3.client('s3', region_name = region_name)
+# Results are restored by the backend that archived them
+backends = create_backends(config, s3_client, glacier_client, vault_name)
 
 
 dynamodb = boto3.resource('dynamodb', region_name=region_name)
 table_name = config.get('DynamoDB','table')
 table = dynamodb.Table(table_name)
+# Seconds after which a retrieval still marked in flight may be retried
+restore_in_flight_seconds = config.getint('restore', 'InFlightSeconds',
+    fallback=86400)
 
+"""The user's archived results (see archive_location)
+"""
 def get_archived_files(user_id):
     # # https://stackoverflow.com/questions/35758924/how-do-we-query-on-a-secondary-index-of-dynamodb-using-boto3
-    response = table.query(
-        IndexName='user_id_index',
-        KeyConditionExpression=Key('user_id').eq(user_id)
-    )
-    items = response.get('Items', [])
-
-    # Extract the archived_results_file from each item
-    archived_files = [item['results_file_archive_id'] for item in items if 'results_file_archive_id' in item]
-    return archived_files
-# Add utility code here
-def initiate_glacier_retrieval(archive_id, user_id, job_id, file_name):
-    try:
-        # Attempt expedited retrieval first
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/initiate_job.html
-        response = glacier_client.initiate_job(
-            vaultName=vault_name,
-            jobParameters={
-                'Type': 'archive-retrieval',
-                'ArchiveId': archive_id,
-                'Tier': 'Expedited'
-            }
+    archived_files = []
+    kwargs = {}
+    while True:
+        response = table.query(
+            IndexName='user_id_index',
+            KeyConditionExpression=Key('user_id').eq(user_id),
+            **kwargs
         )
-    # https://botocore.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/exceptions/InsufficientCapacityException.html
-    except glacier_client.exceptions.InsufficientCapacityException:
-        # Fallback to standard retrieval
-        response = glacier_client.initiate_job(
-            vaultName=vault_name,
-            jobParameters={
-                'Type': 'archive-retrieval',
-                'ArchiveId': archive_id,
-                'Tier': 'Standard'
+        for item in response.get('Items', []):
+            if 'results_file_archive_id' in item:
+                archived_files.append(archive_location(item))
+        if 'LastEvaluatedKey' not in response:
+            return archived_files
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+"""Mark an archive's retrieval as in flight, unless it already is
+The conditional write is the dedup table: of any number of requests for
+the same archive, only the first (or the first after InFlightSeconds,
+should a retrieval have been lost) gets True. thaw.py clears the mark
+when it has copied the results back to S3.
+"""
+def claim_restore(job_id, archive_id):
+    now = int(time.time())
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/update_item.html
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET restore_requested_at = :now',
+            ConditionExpression='results_file_archive_id = :archive_id AND ' +
+                '(attribute_not_exists(restore_requested_at) OR ' +
+                'restore_requested_at < :stale)',
+            ExpressionAttributeValues={
+                ':now': now,
+                ':archive_id': archive_id,
+                ':stale': now - restore_in_flight_seconds
             }
         )
-
-    job_ids = response['jobId']
-    # Send message to SQS with job details
-    sns_client.publish(
-        TopicArn=topic_arn_thaw,
-        Message=json.dumps({
-            'archive_id': archive_id,
-            'user_id': user_id,
-            'job_ids': job_ids,
-            'file_name' : file_name,
-            'job_id': job_id
-        })
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+def release_restore(job_id):
+    table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='REMOVE restore_requested_at'
     )
 
-def process_initiation_messages():
-    while True:
-        response = sqs_client.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=10,
-            WaitTimeSeconds=20
-        )
-        for message in response.get('Messages', []):
-            receipt_handle = message.get('ReceiptHandle')
-            body = json.loads(message['Body'])
-            message = body.get('Message')
-            data_dict = json.loads(message)
-            user_id = data_dict.get("user_id")
-            job_id = data_dict.get("job_id")
-            file_name = data_dict.get("file_name")
-
-            # Query database for archived files of the user
-            archived_files = get_archived_files(user_id)  # Implement this function
-
-            for archive in archived_files:
-                initiate_glacier_retrieval(archive, user_id, job_id, file_name)
-
-            # Delete the message from the queue
-            sqs_client.delete_message(
-                QueueUrl=queue_url,
-                ReceiptHandle=receipt_handle
+# Add utility code here
+"""Send thaw requests to SNS ten at a time
+Returns the messages that could not be published.
+"""
+def publish_thaw_messages(messages):
+    unpublished = []
+    for i in range(0, len(messages), 10):
+        batch = messages[i:i + 10]
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish_batch.html
+            response = sns_client.publish_batch(
+                TopicArn=topic_arn_thaw,
+                PublishBatchRequestEntries=[
+                    {'Id': str(n), 'Message': json.dumps(message)}
+                    for (n, message) in enumerate(batch)
+                ]
             )
+        except ClientError as e:
+            print(f"Failed to publish thaw requests: {e}")
+            unpublished.extend(batch)
+            continue
+        for failure in response.get('Failed', []):
+            print(f"Failed to publish thaw request: {failure.get('Message')}")
+            unpublished.append(batch[int(failure['Id'])])
+    return unpublished
+
+"""Restore a user's archives
+A message carries the user's whole archive list (from views.py on
+subscribe); older per-job messages fall back to looking the archives up.
+Archives already being retrieved are skipped, so repeated or overlapping
+requests start each retrieval once. An archive whose thaw request could
+not be sent is released again, so the redelivered message retries it.
+"""
+def handle_restore_message(data_dict, message):
+    user_id = data_dict.get("user_id")
+    archives = data_dict.get("archives")
+    if archives is None:
+        # Query database for archived files of the user
+        archives = get_archived_files(user_id)
+
+    thaw_messages = []
+    try:
+        for archive in archives:
+            if not claim_restore(archive['job_id'], archive['archive_id']):
+                continue
+            try:
+                backend = backends[archive.get('backend', 'glacier')]
+                job_ids = backend.restore(archive)
+            except Exception:
+                release_restore(archive['job_id'])
+                raise
+            # thaw.py gets the whole location, plus the restore's ticket
+            thaw_message = dict(archive, user_id=user_id, job_ids=job_ids)
+            thaw_messages.append(thaw_message)
+    finally:
+        # Retrievals already started still get thawed if a later one fails
+        unpublished = publish_thaw_messages(thaw_messages)
+        for thaw_message in unpublished:
+            release_restore(thaw_message['job_id'])
+
+    if unpublished:
+        raise RuntimeError(f"{len(unpublished)} thaw requests for user " +
+            f"{user_id} were not sent")
+
+    # Delete the message from the queue
+    return True
+
+def process_initiation_messages():
+    consumer = QueueConsumer(sqs_client, queue_url, handle_restore_message,
+        concurrency=config.getint('consumer', 'Concurrency', fallback=4),
+        visibility_timeout=config.getint('consumer', 'VisibilityTimeout',
+            fallback=300))
+    consumer.run()
 
 if __name__ == "__main__":
     process_initiation_messages()
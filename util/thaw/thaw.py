@@ -11,13 +11,15 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os
 import sys
 import boto3
-import json
-from botocore.exceptions import ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
-import helpers
+from consumer import QueueConsumer, RetryLater
+from glacier_transfer import glacier_part_size
+from archive_backends import create_backends
 import time
+import random
+import threading
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -31,70 +33,181 @@ bucket_name = config.get('S3', 'results_bucket')
 sqs_client = boto3.client('sqs', region_name=region_name)
 glacier_client = boto3.client('glacier', region_name=region_name)
 s3_client = boto3.client('s3', region_name=region_name)
+dynamodb = boto3.resource('dynamodb', region_name=region_name)
+table = dynamodb.Table(config.get('DynamoDB', 'table'))
 queue_url = config.get('SQS', 'queueUrl')
+# Results are restored by the backend that archived them. Ranged copies
+# of Glacier archives into S3: part size (at least 8 MB, as S3 parts must
+# be 5 MB or more), parts fetched at once per restore, and parts in memory
+# at once across all restores
+backends = create_backends(config, s3_client, glacier_client, vault_name,
+    transfer_part_size=glacier_part_size(
+        max(config.getint('transfer', 'PartSizeMB', fallback=16), 8)),
+    transfer_concurrency=config.getint('transfer', 'Concurrency', fallback=4),
+    transfer_slots=threading.BoundedSemaphore(
+        config.getint('transfer', 'MaxPartsInMemory', fallback=8)),
+    # Packed archives are deleted with the last of their jobs' restores
+    pack_table=dynamodb.Table(config.get('pack', 'Table'))
+        if config.has_option('pack', 'Table') else None)
 
 # Add utility code here
-def process_completed_jobs():
-    restored_data = b''
-    while True:
-        response = sqs_client.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=10,
-            WaitTimeSeconds=20
-        )
+"""Tracks every outstanding restore in one table
+
+Restores are keyed (backend name, ticket). A single thread polls for
+all of them at once, each backend's with one completed() call (for
+Glacier, a list_jobs sweep rather than one describe_job loop per job),
+and wakes each restore's waiter as soon as it shows up Succeeded or
+Failed. Polls come every interval seconds while restores keep
+completing and back off (by backoff, up to max_interval) while none do;
+every delay is jittered so several thaw instances do not poll in step.
+Registering a new restore brings the next poll back to within interval.
+"""
+class RestorePoller(object):
+    def __init__(self, backends, interval=60, max_interval=900,
+        backoff=1.5, jitter=0.2):
+
+        self.backends = backends
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.cond = threading.Condition()
+        self.watched = {}
+        self.delay = interval
+        self.next_poll = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def pending(self):
+        return [job_id for (job_id, entry) in self.watched.items()
+            if not entry['done'].is_set()]
+
+    """Wait up to timeout seconds for a restore to complete
+    Returns its status code ('Succeeded' or 'Failed'), or None if it is
+    still running.
+    """
+    def wait(self, job_id, timeout):
+        with self.cond:
+            entry = self.watched.get(job_id)
+            if entry is None:
+                entry = {'done': threading.Event(), 'status': None,
+                    'waiters': 0}
+                self.watched[job_id] = entry
+                self.delay = self.interval
+                self.next_poll = min(self.next_poll,
+                    time.time() + self.jittered(self.interval))
+                self.cond.notify()
+            entry['waiters'] += 1
+
+        entry['done'].wait(timeout)
+
+        with self.cond:
+            entry['waiters'] -= 1
+            if entry['waiters'] == 0:
+                del self.watched[job_id]
+        return entry['status']
+
+    """One sweep per backend; returns how many watched restores completed
+    """
+    def poll_once(self, job_ids):
+        completed = 0
+        for (name, backend) in self.backends.items():
+            tickets = set(ticket for (backend_name, ticket) in job_ids
+                if backend_name == name)
+            if not tickets:
+                continue
+            for (ticket, status) in backend.completed(tickets).items():
+                with self.cond:
+                    entry = self.watched.get((name, ticket))
+                    if entry is not None and not entry['done'].is_set():
+                        entry['status'] = status
+                        entry['done'].set()
+                        completed += 1
+        return completed
+
+    def run(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                job_ids = set(self.pending())
+                if not job_ids or now < self.next_poll:
+                    self.cond.wait(self.next_poll - now if job_ids else None)
+                    continue
 
-        for message in response.get('Messages', []):
-            body = json.loads(message['Body'])
-            message_dict = body.get('Message')
-            data_dict = json.loads(message_dict)
-            restore_job_id = data_dict.get('job_ids')
-            job_id = data_dict.get('job_id')
-            archive_id = data_dict.get('archive_id')
-            user_id = data_dict.get('user_id')
-            file_name = data_dict.get('file_name')
-            status_code = None
-            while status_code != 'Succeeded':
-                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/describe_job.html
-                response_status = glacier_client.describe_job(vaultName=vault_name, jobId=restore_job_id)
-                status_code = response_status['StatusCode']
-                if status_code == 'InProgress':
-                     print(f"Job status is {status_code}. Waiting for completion...")
-                     time.sleep(60)
-
-                elif status_code == 'Succeeded':
-                     print("Job status is completed. Fetching the output...")
-                     # Get the job output
-                     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/get_job_output.html
-                     job_output = glacier_client.get_job_output(vaultName=vault_name, jobId=restore_job_id)
-
-                     restored_data = job_output['body'].read()
-                     break
-
-                elif status_code == 'Failed':
-                     print("Job failed. Please check the job details.")
-                     break
+            try:
+                completed = self.poll_once(job_ids)
+            except Exception as e:
+                print(f"Failed to poll restores: {e}")
+                completed = 0
+
+            with self.cond:
+                if completed:
+                    self.delay = self.interval
                 else:
-                     print(f"Job status is {status_code}. Waiting for completion...")
-                     time.sleep(60)
-            # Move the object to S3
-            file_name_correct = file_name.split(".")[0]
-            s3_key = f'koyya/{user_id}/{job_id}/{file_name_correct}.annot.vcf'
-            # https://stackoverflow.com/questions/40336918/how-to-write-a-file-or-data-to-an-s3-object-using-boto3
-            s3_client.put_object(
-                Bucket=bucket_name,
-                Key=s3_key,
-                Body=restored_data
-            )
-
-            # Delete the archive from Glacier
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/glacier/client/delete_archive.html
-            glacier_client.delete_archive(vaultName=vault_name, archiveId=archive_id)
-
-            # Delete the message from the queue
-            sqs_client.delete_message(
-                QueueUrl=queue_url,
-                ReceiptHandle=message['ReceiptHandle']
-            )
+                    self.delay = min(self.delay * self.backoff,
+                        self.max_interval)
+                self.next_poll = time.time() + self.jittered(self.delay)
+
+
+poller = RestorePoller(backends,
+    interval=config.getint('poller', 'PollSeconds', fallback=60),
+    max_interval=config.getint('poller', 'MaxPollSeconds', fallback=900))
+# Seconds a handler waits on its job before handing the message back
+hold_seconds = config.getint('poller', 'HoldSeconds', fallback=900)
+
+def handle_thaw_message(data_dict, message):
+    restore_job_id = data_dict.get('job_ids')
+    job_id = data_dict.get('job_id')
+    user_id = data_dict.get('user_id')
+    file_name = data_dict.get('file_name')
+    backend = backends[data_dict.get('backend', 'glacier')]
+
+    status_code = poller.wait((backend.name, restore_job_id), hold_seconds)
+    if status_code is None:
+        # Still running; look again when the message comes back
+        print(f"Restore {restore_job_id} is still in progress")
+        raise RetryLater(poller.jittered(poller.delay))
+    if status_code != 'Succeeded':
+        print(f"Restore {restore_job_id} failed. Please check the job details.")
+        # Clear the in-flight mark, so the next restore request for this
+        # job starts a new retrieval rather than waiting out InFlightSeconds
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='REMOVE restore_requested_at'
+        )
+        return True
+
+    print("Restore is completed. Fetching the output...")
+    file_name_correct = file_name.split(".")[0]
+    s3_key = f'koyya/{user_id}/{job_id}/{file_name_correct}.annot.vcf'
+    backend.finish(data_dict, restore_job_id, bucket_name, s3_key)
+
+    # The results are back in S3; clear the archive and the in-flight mark
+    # restore.py set, so the archive is never asked for again
+    table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='REMOVE ' + ', '.join(backend.CLEARED +
+            ['archive_backend', 'restore_requested_at'])
+    )
+
+    # Delete the message from the queue
+    return True
+
+def process_completed_jobs():
+    # Handlers wait on the shared poller rather than polling their
+    # backends themselves, so many can wait at once; their messages stay invisible
+    # while they wait
+    poller.start()
+    consumer = QueueConsumer(sqs_client, queue_url, handle_thaw_message,
+        concurrency=config.getint('consumer', 'Concurrency', fallback=32),
+        visibility_timeout=config.getint('consumer', 'VisibilityTimeout',
+            fallback=300))
+    consumer.run()
 
 if __name__ == "__main__":
     process_completed_jobs()
@@ -63,6 +63,12 @@ class Config(object):
     '@' + rds_secret['host'] + ':' + str(rds_secret['port']) + \
     '/' + SQLALCHEMY_DATABASE_TABLE
   SQLALCHEMY_TRACK_MODIFICATIONS = True
+  # Keep a pool of accounts database connections, checked before use
+  SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': 5,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800
+  }
 
   # Get the Globus Auth client ID and secret
   try:
@@ -103,6 +109,13 @@ class Config(object):
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "koyya_annotations"
 
+  # User roles are cached for all app workers in a local SQLite file
+  PROFILE_CACHE_PATH = "/tmp/gas_profile_cache.db"
+  PROFILE_CACHE_TTL = 300
+
+  # Annotation jobs listed per page
+  ANNOTATIONS_PAGE_SIZE = 25
+
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "koyya@mpcs-cc.com"
 
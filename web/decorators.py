@@ -11,8 +11,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 from flask import redirect, request, session, url_for
 from functools import wraps
 
-from gas import db
-from models import Profile
+from profile_cache import get_role
 
 """Mark a route as requiring authentication
 """
@@ -34,16 +33,19 @@ def authenticated(fn):
 
 """Mark a route as accessible to subscribers (premium users) only
 Subscriber must have profile.role = premium_user
+The role comes from the shared profile cache, so most requests don't
+touch the accounts database, and the session is kept in step with it.
 """
 def is_premium(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
     # Check if user is a subscriber
-    profile = db.session.query(Profile).filter_by(identity_id=session.get('primary_identity')).first()
-    if not profile:
+    role = get_role(session.get('primary_identity'))
+    if not role:
       # Force login
       return redirect(url_for('login', next=request.url))
-    elif (profile.role != "premium_user"):
+    session['role'] = role
+    if (role != "premium_user"):
       # Redirect free user to subscribe
       return redirect(url_for('subscribe', next=request.url))
 
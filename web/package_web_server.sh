@@ -0,0 +1,19 @@
+#!/bin/bash
+
+# package_web_server.sh
+#
+# Builds gas_web_server.zip, the bundle web server instances unzip into
+# gas/web at launch (see aws/user_data_web_server.txt), and uploads it.
+# archive_location.py lives in util/ and is shared with restore.py, so it
+# is copied into the bundle next to views.py.
+
+cd "$(dirname "$0")"
+BUNDLE=$(mktemp -d)
+
+cp -r . $BUNDLE
+cp ../util/archive_location.py $BUNDLE/archive_location.py
+rm -rf $BUNDLE/gas_web_server.zip $(find $BUNDLE -name __pycache__)
+
+(cd $BUNDLE && zip -qr gas_web_server.zip .)
+aws s3 cp $BUNDLE/gas_web_server.zip s3://mpcs-cc-students/koyya/gas_web_server.zip
+rm -rf $BUNDLE
@@ -0,0 +1,94 @@
+# profile_cache.py
+#
+# Copyright (C) 2011-2020 Vas Vasiliadis
+# University of Chicago
+#
+# Read-through cache of user roles, shared by the app's worker processes
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import sqlite3
+import threading
+
+from gas import app, db
+from models import Profile
+
+"""Roles by identity, kept for ttl seconds in a local SQLite file
+Every Gunicorn worker on the host opens the same file, so a role looked
+up by one worker is served to all of them, and an invalidation made by
+one is seen by all of them at once. Only the role is cached: it is all
+the request path needs, and it only changes through update_profile in
+views.py, which invalidates the entry.
+"""
+class ProfileCache(object):
+  def __init__(self, path, ttl=300):
+    self.path = path
+    self.ttl = ttl
+    # SQLite connections can't be shared between threads
+    self.local = threading.local()
+
+  def connection(self):
+    connection = getattr(self.local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=5,
+        isolation_level=None)
+      # WAL lets readers in other workers go on while one writes
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('CREATE TABLE IF NOT EXISTS roles ' +
+        '(identity_id TEXT PRIMARY KEY, role TEXT, expires REAL)')
+      self.local.connection = connection
+    return connection
+
+  def get(self, identity_id):
+    row = self.connection().execute(
+      'SELECT role, expires FROM roles WHERE identity_id = ?',
+      (str(identity_id),)).fetchone()
+    if row and row[1] > time.time():
+      return row[0]
+    return None
+
+  def put(self, identity_id, role):
+    self.connection().execute(
+      'INSERT OR REPLACE INTO roles (identity_id, role, expires) ' +
+      'VALUES (?, ?, ?)', (str(identity_id), role, time.time() + self.ttl))
+
+  def invalidate(self, identity_id):
+    self.connection().execute('DELETE FROM roles WHERE identity_id = ?',
+      (str(identity_id),))
+
+profile_cache = ProfileCache(app.config['PROFILE_CACHE_PATH'],
+  ttl=app.config['PROFILE_CACHE_TTL'])
+
+"""Get a user's role, from the cache if it is there
+Returns None if the user has no profile. A cache that can't be read or
+written is passed over, so the database is always the fallback.
+"""
+def get_role(identity_id):
+  try:
+    role = profile_cache.get(identity_id)
+    if role:
+      return role
+  except sqlite3.Error as e:
+    app.logger.error(f"Profile cache read failed: {e}")
+
+  profile = db.session.query(Profile.role) \
+    .filter_by(identity_id=identity_id).first()
+  if not profile:
+    return None
+  try:
+    profile_cache.put(identity_id, profile.role)
+  except sqlite3.Error as e:
+    app.logger.error(f"Profile cache write failed: {e}")
+  return profile.role
+
+"""Drop a user's cached role; call whenever their role is changed
+"""
+def invalidate_role(identity_id):
+  try:
+    profile_cache.invalidate(identity_id)
+  except sqlite3.Error as e:
+    app.logger.error(f"Profile cache invalidation failed: {e}")
+
+### EOF
@@ -9,9 +9,12 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import sys
 import uuid
 import time
 import json
+import base64
 from datetime import datetime, timedelta
 
 import boto3
@@ -25,6 +28,12 @@ from flask import (abort, flash, redirect, render_template,
 from gas import app, db
 from decorators import authenticated, is_premium
 from auth import get_profile, update_profile
+from profile_cache import invalidate_role
+# Shared with util/restore: package_web_server.sh bundles archive_location.py
+# next to this file; in a repository checkout it is found in util/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  os.pardir, 'util'))
+from archive_location import archive_location
 import requests
 
 s3 = boto3.client('s3',
@@ -180,42 +189,71 @@ def create_annotation_job(s3_bucket, s3_key):
       print(f"Failed to store job data in DynamoDB: {str(e)}")
       return None
 
-def query_user_jobs(user_id):
-    try:
-        # Query DynamoDB to retrieve jobs for the specified user
-        # https://stackoverflow.com/questions/35758924/how-do-we-query-on-a-secondary-index-of-dynamodb-using-boto3
-        response = annotations_table.query(
-            IndexName = 'user_id_index',
-            KeyConditionExpression=Key('user_id').eq(user_id)
-        )
+"""Encode a DynamoDB LastEvaluatedKey as an opaque, URL-safe page cursor
+"""
+def encode_cursor(key):
+  # Key values are strings, or Decimal for numeric index keys
+  data = json.dumps(key, default=int, separators=(',', ':'))
+  return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
 
-        # Extract the jobs from the response
-        jobs = response.get('Items')
-        job_ids = [job['job_id'] for job in jobs]
+def decode_cursor(cursor, user_id):
+  try:
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+  except ValueError:
+    abort(400)
+  # A cursor only pages through its own user's jobs
+  if not isinstance(key, dict) or key.get('user_id') != user_id:
+    abort(400)
+  return key
+
+"""Fetch one page of a user's jobs from the user_id_index
+Only the attributes the listing renders are read, in a single query;
+returns the jobs and the cursor of the next page (None on the last page).
+"""
+def query_user_jobs(user_id, cursor=None, limit=25):
+  kwargs = {}
+  if cursor:
+    kwargs['ExclusiveStartKey'] = decode_cursor(cursor, user_id)
+  try:
+    # Query DynamoDB to retrieve jobs for the specified user
+    # https://stackoverflow.com/questions/35758924/how-do-we-query-on-a-secondary-index-of-dynamodb-using-boto3
+    response = annotations_table.query(
+      IndexName='user_id_index',
+      KeyConditionExpression=Key('user_id').eq(user_id),
+      ProjectionExpression='job_id, submit_time, input_file_name, job_status',
+      Limit=limit,
+      **kwargs
+    )
+  except ClientError as e:
+    # Handle any errors that may occur during the query
+    app.logger.error(f"Error querying user jobs: {e}")
+    return ([], None)
 
-        return job_ids
-    except Exception as e:
-        # Handle any errors that may occur during the query
-        app.logger.error(f"Error querying user jobs: {e}")
-        return []
+  jobs = response.get('Items', [])
+  for job in jobs:
+    if job.get('submit_time'):
+      job['submit_time'] = datetime.fromtimestamp(job['submit_time']) \
+        .strftime('%Y-%m-%d %H:%M:%S')
+  next_key = response.get('LastEvaluatedKey')
+  return (jobs, encode_cursor(next_key) if next_key else None)
 
 
 """List all annotations for the user
+The list is paged with cursors: ?cursor= holds the DynamoDB key the page
+starts after, and ?prev= the cursor of the page before it (empty for
+the first page), so the page can link back one step as well as forward
+without keeping anything in the session.
 """
 @app.route('/annotations', methods=['GET'])
 @authenticated
 def annotations_list():
+  cursor = request.args.get('cursor')
+  (annotations, next_cursor) = query_user_jobs(session['primary_identity'],
+    cursor=cursor, limit=app.config['ANNOTATIONS_PAGE_SIZE'])
 
-  # Get list of annotations to display
-  jobs = list_user_jobs()
-  job_details = [query_job_details(job_id) for job_id in jobs]
-  return render_template('annotations.html', annotations=job_details)
-
-def list_user_jobs():
-    # Retrieve user's jobs from DynamoDB
-    user_id = session['primary_identity']
-    job_ids = query_user_jobs(user_id)
-    return job_ids
+  return render_template('annotations.html', annotations=annotations,
+    cursor=cursor, prev_cursor=request.args.get('prev'),
+    next_cursor=next_cursor)
 
 def query_job_details(job_id):
     try:
@@ -345,6 +383,7 @@ def subscribe():
       identity_id=session['primary_identity'],
       role="premium_user"
     )
+    invalidate_role(session['primary_identity'])
 
     # Update role in the session
     session['role'] = "premium_user"
@@ -356,22 +395,87 @@ def subscribe():
 
     # Display confirmation page
     return render_template('subscribe_confirm.html')
-def restore_archived_result_files(user_id):
-    response = annotations_table.query(
-        IndexName='user_id_index',
-        KeyConditionExpression=Key('user_id').eq(user_id)
-    )
-    
-    items = response.get('Items', [])
+"""Ask restore.py to retrieve all of a user's archived results
+One message per user carries the archive list, split so each message
+fits in SNS, and the messages are published up to ten (and 256 KB) at a
+time. Entries SNS reports as failed are published again, a few times,
+before giving up. restore.py skips archives already being retrieved.
+"""
+# SNS takes at most 256 KB in one message, and in one publish_batch
+SNS_MAX_BYTES = 256 * 1024
 
-    # Process each archived file
-    for item in items:
-        if 'results_file_archive_id' in item:
-            archive_id = item['results_file_archive_id']
-            job_id = item.get('job_id', str(uuid.uuid4()))
-            file_name = item.get('input_file_name')
-            sns_client = boto3.client('sns', region_name = app.config['AWS_REGION_NAME'])
-            sns_client.publish(TopicArn = topic_arn_restore,  Message=json.dumps({'user_id': user_id, 'job_id':job_id, 'file_name':file_name}))
+def restore_archived_result_files(user_id):
+    archives = []
+    kwargs = {}
+    while True:
+        response = annotations_table.query(
+            IndexName='user_id_index',
+            KeyConditionExpression=Key('user_id').eq(user_id),
+            **kwargs
+        )
+        for item in response.get('Items', []):
+            if 'results_file_archive_id' in item:
+                archives.append(archive_location(item))
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    sns_client = boto3.client('sns', region_name = app.config['AWS_REGION_NAME'])
+    publish_in_batches(sns_client, topic_arn_restore,
+        restore_messages(user_id, archives))
+
+"""Restore messages for a user's archives, as JSON strings, each holding
+as many archives as fit in one SNS message
+"""
+def restore_messages(user_id, archives):
+    empty = len(json.dumps({'user_id': user_id, 'archives': []}))
+    messages = []
+    batch = []
+    size = empty
+    for archive in archives:
+        # Each archive adds its JSON plus a ', ' separator
+        archive_size = len(json.dumps(archive)) + 2
+        if batch and (size + archive_size > SNS_MAX_BYTES):
+            messages.append(json.dumps({'user_id': user_id, 'archives': batch}))
+            batch = []
+            size = empty
+        batch.append(archive)
+        size += archive_size
+    if batch:
+        messages.append(json.dumps({'user_id': user_id, 'archives': batch}))
+    return messages
+
+"""Publish messages with publish_batch, in batches of up to ten messages
+and SNS_MAX_BYTES; raises if some still fail after attempts tries
+"""
+def publish_in_batches(sns_client, topic_arn, messages, attempts=3):
+    for attempt in range(attempts):
+        batches = []
+        for message in messages:
+            if (not batches) or (len(batches[-1]) == 10) or \
+                (sum(len(m) for m in batches[-1]) + len(message) > SNS_MAX_BYTES):
+                batches.append([])
+            batches[-1].append(message)
+
+        failed = []
+        for batch in batches:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish_batch.html
+            response = sns_client.publish_batch(
+                TopicArn = topic_arn,
+                PublishBatchRequestEntries=[
+                    {'Id': str(n), 'Message': message}
+                    for (n, message) in enumerate(batch)
+                ]
+            )
+            for failure in response.get('Failed', []):
+                app.logger.error(f"Failed to publish to {topic_arn}: " +
+                    f"{failure.get('Message')}")
+                failed.append(batch[int(failure['Id'])])
+        if not failed:
+            return
+        messages = failed
+    raise RuntimeError(f"{len(messages)} messages to {topic_arn} " +
+        f"were not published")
 
 """Reset subscription
 """
@@ -383,6 +487,7 @@ def unsubscribe():
     identity_id=session['primary_identity'],
     role="free_user"
   )
+  invalidate_role(session['primary_identity'])
   return redirect(url_for('profile'))
 
 